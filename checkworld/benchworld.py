@@ -0,0 +1,390 @@
+#!/usr/bin/env python2.7
+#
+# benchworld.py - Benchmark for checkworld.py
+# Copyright (c) 2010, 2011 sk89q <http://www.sk89q.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id#
+
+import sys
+import os.path
+import os
+import gzip
+import zlib
+import random
+import time
+import json
+import platform
+from struct import Struct
+import argparse
+
+from checkworld import ChunkValidator, ChunkScanner, RegionValidator
+
+byte_fmt = Struct(">b")
+short_fmt = Struct(">h")
+int_fmt = Struct(">i")
+long_fmt = Struct(">q")
+float_fmt = Struct(">f")
+double_fmt = Struct(">d")
+
+corruption_types = ['block', 'dupe', 'gzip', 'pos']
+
+def to_base36(value):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    negative = value < 0
+    value = abs(value)
+    out = ""
+    while True:
+        value, digit = divmod(value, 36)
+        out = digits[digit] + out
+        if value == 0:
+            break
+    return "-" + out if negative else out
+
+def chunk_path(world, x, z):
+    return os.path.join(world, to_base36(x % 64), to_base36(z % 64),
+                        "c.{0}.{1}.dat".format(to_base36(x), to_base36(z)))
+
+def named(type_id, name, payload):
+    name = name.encode("utf8")
+    return chr(type_id) + short_fmt.pack(len(name)) + name + payload
+
+def string_payload(value):
+    value = value.encode("utf8")
+    return short_fmt.pack(len(value)) + value
+
+def list_payload(type_id, payloads):
+    return chr(type_id) + int_fmt.pack(len(payloads)) + "".join(payloads)
+
+def compound_payload(tags):
+    return "".join(tags) + "\x00"
+
+def make_entity(rand, x, z):
+    pos = [x * 16 + rand.random() * 16, 64 + rand.random() * 32, z * 16 + rand.random() * 16]
+    return compound_payload([
+        named(8, "id", string_payload(rand.choice(["Pig", "Cow", "Sheep", "Zombie", "Creeper"]))),
+        named(9, "Pos", list_payload(6, [double_fmt.pack(v) for v in pos])),
+        named(9, "Motion", list_payload(6, [double_fmt.pack(0.0)] * 3)),
+        named(9, "Rotation", list_payload(5, [float_fmt.pack(rand.random() * 360), float_fmt.pack(0.0)])),
+        named(5, "FallDistance", float_fmt.pack(0.0)),
+        named(2, "Fire", short_fmt.pack(-1)),
+        named(2, "Air", short_fmt.pack(300)),
+        named(1, "OnGround", byte_fmt.pack(1)),
+        named(2, "Health", short_fmt.pack(10)),
+    ])
+
+def make_item_entity(rand, x, z):
+    pos = [x * 16 + rand.random() * 16, 64 + rand.random() * 32, z * 16 + rand.random() * 16]
+    return compound_payload([
+        named(8, "id", string_payload("Item")),
+        named(9, "Pos", list_payload(6, [double_fmt.pack(v) for v in pos])),
+        named(9, "Motion", list_payload(6, [double_fmt.pack(0.0)] * 3)),
+        named(9, "Rotation", list_payload(5, [float_fmt.pack(rand.random() * 360), float_fmt.pack(0.0)])),
+        named(5, "FallDistance", float_fmt.pack(0.0)),
+        named(2, "Fire", short_fmt.pack(-1)),
+        named(2, "Air", short_fmt.pack(300)),
+        named(1, "OnGround", byte_fmt.pack(1)),
+        named(2, "Health", short_fmt.pack(5)),
+        named(2, "Age", short_fmt.pack(rand.randint(0, 6000))),
+        named(10, "Item", compound_payload([
+            named(2, "id", short_fmt.pack(rand.choice([3, 4, 263, 264, 265]))),
+            named(2, "Damage", short_fmt.pack(0)),
+            named(1, "Count", byte_fmt.pack(rand.randint(1, 64))),
+        ])),
+    ])
+
+def make_tile_entity(rand, x, z):
+    id = rand.choice(["Chest", "Sign", "Furnace"])
+    tags = [
+        named(8, "id", string_payload(id)),
+        named(3, "x", int_fmt.pack(x * 16 + rand.randint(0, 15))),
+        named(3, "y", int_fmt.pack(rand.randint(0, 127))),
+        named(3, "z", int_fmt.pack(z * 16 + rand.randint(0, 15))),
+    ]
+    if id == "Chest":
+        items = []
+        for slot in xrange(rand.randint(0, 27)):
+            items.append(compound_payload([
+                named(2, "id", short_fmt.pack(rand.randint(1, 25))),
+                named(2, "Damage", short_fmt.pack(0)),
+                named(1, "Count", byte_fmt.pack(rand.randint(1, 64))),
+                named(1, "Slot", byte_fmt.pack(slot)),
+            ]))
+        tags.append(named(9, "Items", list_payload(10, items)))
+    elif id == "Sign":
+        for i in xrange(1, 5):
+            tags.append(named(8, "Text" + str(i), string_payload("line %d" % i)))
+    elif id == "Furnace":
+        tags.append(named(2, "BurnTime", short_fmt.pack(0)))
+        tags.append(named(2, "CookTime", short_fmt.pack(0)))
+        tags.append(named(9, "Items", list_payload(10, [])))
+    return compound_payload(tags)
+
+def make_chunk(rand, x, z, corruption=None):
+    """Builds the uncompressed NBT for a chunk at (x, z). corruption is one of
+    the entries in corruption_types that can be fixed in the NBT itself."""
+    blocks = bytearray(32768)
+    height = rand.randint(48, 80)
+    for column in xrange(256):
+        base = column * 128
+        blocks[base] = 7 # Bedrock
+        blocks[base + 1:base + height - 4] = "\x01" * (height - 5)
+        blocks[base + height - 4:base + height - 1] = "\x03\x03\x03"
+        blocks[base + height - 1] = 2
+    for i in xrange(64): # Some ores
+        blocks[rand.randint(0, 32767) & ~127 | rand.randint(1, 40)] = rand.choice([14, 15, 16, 56])
+    if corruption == "block":
+        blocks[rand.randint(0, 32767)] = rand.choice([30, 36, 120, 200])
+    entities = [make_entity(rand, x, z) for i in xrange(rand.randint(0, 4))]
+    entities.extend([make_item_entity(rand, x, z) for i in xrange(rand.randint(0, 2))])
+    if corruption == "dupe": # What an item duping exploit leaves behind
+        entities.extend([make_item_entity(rand, x, z) for i in xrange(5000)])
+    x_pos, z_pos = x, z
+    if corruption == "pos":
+        if rand.random() < 0.5:
+            x_pos = x_pos + rand.choice([-1, 1])
+        else:
+            z_pos = z_pos + rand.choice([-1, 1])
+    level = compound_payload([
+        named(7, "Blocks", int_fmt.pack(32768) + str(blocks)),
+        named(7, "Data", int_fmt.pack(16384) + "\x00" * 16384),
+        named(7, "SkyLight", int_fmt.pack(16384) + "\xff" * 16384),
+        named(7, "BlockLight", int_fmt.pack(16384) + "\x00" * 16384),
+        named(7, "HeightMap", int_fmt.pack(256) + chr(height) * 256),
+        named(9, "Entities", list_payload(10, entities)),
+        named(9, "TileEntities", list_payload(10,
+            [make_tile_entity(rand, x, z) for i in xrange(rand.randint(0, 3))])),
+        named(4, "LastUpdate", long_fmt.pack(rand.randint(0, 1000000))),
+        named(1, "TerrainPopulated", byte_fmt.pack(1)),
+        named(3, "xPos", int_fmt.pack(x_pos)),
+        named(3, "zPos", int_fmt.pack(z_pos)),
+    ])
+    return named(10, "", compound_payload([named(10, "Level", level)]))
+
+def write_chunk(path, data, truncate=False):
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    f = open(path, "wb")
+    try:
+        # A fixed mtime keeps the output byte-for-byte reproducible
+        gz = gzip.GzipFile("", "wb", 9, f, mtime=0)
+        gz.write(data)
+        gz.close()
+        if truncate:
+            f.truncate(f.tell() // 2)
+    finally:
+        f.close()
+
+def write_region(path, chunks):
+    """Writes a McRegion file from a dict of chunk index to uncompressed NBT.
+    Chunks whose NBT is paired with truncate=True get a truncated stream."""
+    dir = os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    locations = [0] * 1024
+    sectors = []
+    offset = 2
+    for index in sorted(chunks):
+        data, truncate = chunks[index]
+        compressed = zlib.compress(data, 9)
+        if truncate:
+            compressed = compressed[:len(compressed) // 2]
+        payload = int_fmt.pack(len(compressed) + 1) + "\x02" + compressed
+        count = (len(payload) + 4095) // 4096
+        locations[index] = offset << 8 | count
+        sectors.append(payload.ljust(count * 4096, "\x00"))
+        offset = offset + count
+    f = open(path, "wb")
+    try:
+        f.write("".join([int_fmt.pack(l) for l in locations]))
+        f.write("\x00" * 4096) # Timestamps
+        f.write("".join(sectors))
+    finally:
+        f.close()
+
+def generate_world(world, size, bad_fraction, seed, format="alpha"):
+    """Writes a size x size chunk world centered on the origin, either as
+    loose chunk files (alpha) or as McRegion files (mcregion). Returns a dict
+    of how many chunks of each corruption type were written."""
+    rand = random.Random(seed)
+    counts = dict.fromkeys(corruption_types, 0)
+    regions = {}
+    half = size // 2
+    for x in xrange(-half, size - half):
+        for z in xrange(-half, size - half):
+            corruption = None
+            if rand.random() < bad_fraction:
+                corruption = rand.choice(corruption_types)
+                counts[corruption] = counts[corruption] + 1
+            data = make_chunk(rand, x, z, corruption)
+            if format == "mcregion":
+                region = regions.setdefault((x >> 5, z >> 5), {})
+                region[(x & 31) + (z & 31) * 32] = (data, corruption == "gzip")
+            else:
+                write_chunk(chunk_path(world, x, z), data, truncate=corruption == "gzip")
+    for region_x, region_z in sorted(regions):
+        path = os.path.join(world, "region", "r.{0}.{1}.mcr".format(region_x, region_z))
+        write_region(path, regions[(region_x, region_z)])
+    return counts
+
+def time_config(files, options, repeat):
+    """Times parsing, validation and the whole run for one set of validator
+    options. The fastest of the repeated runs is kept for each phase."""
+    best = {'parse': None, 'validate': None, 'total': None}
+    chunks = 0
+    bad = 0
+    for i in xrange(repeat):
+        parse = 0.0
+        validate = 0.0
+        chunks = 0
+        bad = 0
+        start = time.time()
+        for path, data, coords, compression in files:
+            chunks = chunks + 1
+            try:
+                validator = ChunkValidator(path, coords=coords, compression=compression,
+                                           **options)
+                t = time.time()
+                tags = list(validator.read_root_tags(data))
+                parse = parse + time.time() - t
+                t = time.time()
+                validator.validate_root_tags(tags)
+                validate = validate + time.time() - t
+            except Exception, e:
+                bad = bad + 1
+        total = time.time() - start
+        for name, value in (('parse', parse), ('validate', validate), ('total', total)):
+            if best[name] == None or value < best[name]:
+                best[name] = value
+    best['chunks'] = chunks
+    best['bad'] = bad
+    return best
+
+def load_chunks(world):
+    """Reads every chunk of a world into memory so that disk access is left
+    out of the timings. Returns a sorted list of (path, data, coords,
+    compression) tuples and the total size of the files."""
+    files = []
+    size = 0
+    for path in ChunkScanner(world):
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        size = size + len(data)
+        if not path.endswith(".mcr"):
+            files.append((path, data, None, "gzip"))
+            continue
+        region = RegionValidator(path, data)
+        if region.validate_header() != None:
+            continue
+        for index, location in enumerate(region.locations):
+            if location == 0:
+                continue
+            try:
+                compression, chunk_data = region.read_chunk(location)
+            except Exception, e:
+                continue
+            files.append((region.chunk_label(index), chunk_data,
+                          region.chunk_coords(index), compression))
+    files.sort()
+    return files, size
+
+def run_benchmark(world, configs, repeat):
+    files, size = load_chunks(world)
+    results = []
+    for name, options in configs:
+        result = time_config(files, options, repeat)
+        result['name'] = name
+        result['options'] = options
+        result['bytes'] = size
+        results.append(result)
+    return results
+
+configs = [
+    ('stream', {'engine': 'stream', 'lazy': False}),
+    ('stream-lazy', {'engine': 'stream', 'lazy': True}),
+    ('fast', {'engine': 'fast', 'lazy': False}),
+    ('fast-lazy', {'engine': 'fast', 'lazy': True}),
+]
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchworld.py',
+                                     description='Benchmarks checkworld.py on a synthetic world')
+    parser.add_argument('--world', metavar='world', type=str, default='benchworld',
+                        help='world directory to generate or benchmark')
+    parser.add_argument('--size', metavar='N', type=int, default=32,
+                        help='generate an N x N chunk world (default 32)')
+    parser.add_argument('--bad', metavar='fraction', type=float, default=0.05,
+                        help='fraction of generated chunks to corrupt (default 0.05)')
+    parser.add_argument('--seed', metavar='seed', type=int, default=1,
+                        help='random seed for the generator (default 1)')
+    parser.add_argument('--format', metavar='format', type=str, default='alpha',
+                        choices=['alpha', 'mcregion'],
+                        help='generate loose chunk files (alpha) or region files (mcregion)')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='number of timed runs per configuration (default 3)')
+    parser.add_argument('--config', dest='configs', metavar='name', action='append',
+                        choices=[c[0] for c in configs],
+                        help='only benchmark the given configuration (repeatable)')
+    parser.add_argument('--json', metavar='filename', type=str,
+                        help='also write the results to a JSON file')
+    parser.add_argument('action', metavar='action', type=str,
+                        choices=['generate', 'run'],
+                        help='an action to perform')
+
+    args = parser.parse_args()
+
+    if args.action == 'generate':
+        if os.path.exists(args.world):
+            print("error: {0} already exists".format(args.world))
+            sys.exit(1)
+        print("Generating a {0}x{0} chunk world in {1}...".format(args.size, args.world))
+        counts = generate_world(args.world, args.size, args.bad, args.seed, args.format)
+        print("Corrupted chunks: " + ", ".join(
+                ["{0}={1}".format(k, counts[k]) for k in corruption_types]))
+        return
+
+    if not os.path.isdir(args.world):
+        print("error: World directory does not exist")
+        sys.exit(1)
+
+    selected = [c for c in configs if not args.configs or c[0] in args.configs]
+    results = run_benchmark(args.world, selected, args.repeat)
+
+    print("{0:<12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format(
+            "config", "chunks", "parse s", "valid. s", "total s", "chunks/s", "MB/s"))
+    for r in results:
+        print("{0:<12} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.1f} {6:>10.2f}".format(
+                r['name'], r['chunks'], r['parse'], r['validate'], r['total'],
+                r['chunks'] / r['total'], r['bytes'] / r['total'] / 1048576.0))
+
+    if args.json:
+        f = open(args.json, "wb")
+        try:
+            json.dump({
+                'world': os.path.abspath(args.world),
+                'repeat': args.repeat,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == "__main__":
+    main()
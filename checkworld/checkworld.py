@@ -21,144 +21,690 @@
 import sys
 import os.path
 import os
-from glob import glob
 import re
 import io
 import gzip
 from struct import Struct
 import argparse
+import itertools
+import functools
+import multiprocessing
+import hashlib
+import sqlite3
+from cStringIO import StringIO
+import threading
+import zlib
+import time
+import heapq
+import json
+import mmap
+import shutil
+import math
+import binascii
+import select
+import signal
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-tag_types = None
+from nbt import BufferReader, FastDecoder, read_named_tags, write_named_tag, \
+    FormatParseException, ByteTag, ShortTag, IntTag, LongTag, FloatTag, \
+    DoubleTag, ByteArrayTag, StringTag, ListTag, CompoundTag
 
 class CheckerException(Exception): pass
-class FormatParseException(CheckerException): pass
-class UnknownTagTypeError(FormatParseException): pass
-class DuplicateNamedTagError(FormatParseException): pass
 class UnexpectedTagError(FormatParseException): pass
-class ValidationError(CheckerException): pass
+class ValidationError(CheckerException):
+    tag_path = None # Path of the tag that failed, filled in by the checks
 class BadItemTypeError(ValidationError): pass
+class TooManyEntitiesError(ValidationError): pass
 
-class BaseTag(object):
-    unnamed = False
-    def __init__(self, data, parent):
-        self.data = data
-        self.parent = parent
-        self.name = "?"
-    def __repr__(self):
-        return repr(self.data)
-    @classmethod
-    def read(cls, reader, parent):
-        return cls(cls.fmt.unpack(reader.read(cls.fmt.size))[0], parent)
+class DecompressionError(CheckerException):
+    def __init__(self, message, offset=None):
+        CheckerException.__init__(self, message)
+        self.offset = offset # Offset in the compressed data where decoding broke
 
-class EndTag(BaseTag):
-    unnamed = True
-    def __init__(self):
-        self.data = None
-
-class ByteTag(BaseTag): fmt = Struct(">b")
-class ShortTag(BaseTag): fmt = Struct(">h")
-class IntTag(BaseTag): fmt = Struct(">i")
-class LongTag(BaseTag): fmt = Struct(">q")
-class FloatTag(BaseTag): fmt = Struct(">f")
-class DoubleTag(BaseTag): fmt = Struct(">d")
-
-class ByteArrayTag(BaseTag):
-    def __repr__(self):
-        return "<{0} bytes>".format(len(self.data))
-    @classmethod
-    def read(cls, reader, parent):
-        size = IntTag.read(reader, None).data
-        return ByteArrayTag(reader.read(size), parent)
+def build_byte_table(is_valid):
+    """Builds a 256-character translation table that maps every byte value
+    that passes is_valid() to a NUL and every other value to 0x01. Running
+    data through str.translate() with the table and searching for 0x01 finds
+    the first bad byte without a Python-level loop."""
+    return "".join(["\x00" if is_valid(i) else "\x01" for i in xrange(256)])
 
-class StringTag(BaseTag):
-    @classmethod
-    def read(cls, reader, parent):
-        size = ShortTag.read(reader, None).data
-        return StringTag(reader.read(size).decode("utf8"), parent)
-
-class ListTag(BaseTag):
-    def __len__(self):
-        return len(self.data)
-    def __getitem__(self, index):
-        return self.data[index]
-    def __repr__(self):
-        return ",".join([repr(i) for i in self.data])
-    @classmethod
-    def read(cls, reader, parent):
-        list_tag = ListTag([], parent)
-        tag_id = ByteTag.read(reader, None).data
-        tag_cls = tag_types[tag_id]
-        count = IntTag.read(reader, None).data
-        for tag in read_tags(reader, tag_id, count, list_tag):
-            list_tag.data.append(tag)
-        return list_tag
-
-class CompoundTag(BaseTag):
-    def __contains__(self, key):
-        return key in self.data
-    def __getitem__(self, key):
-        return self.data[key]
-    def __repr__(self):
-        return "{" + ", ".join(["%s=%s" % (k, repr(self.data[k])) for k in self.data]) + "}"
-    @classmethod
-    def read(cls, reader, parent):
-        compound_tag = CompoundTag({}, parent)
-        for name, tag in read_named_tags(reader, compound_tag):
-            if not tag.unnamed: # Ignore end tags
-                if name in compound_tag.data:
-                    raise DuplicateNamedTagError(name)
-                compound_tag.data[name] = tag
-        return compound_tag
-
-tag_types = [
-    EndTag, ByteTag, ShortTag, IntTag, LongTag, FloatTag, DoubleTag,
-    ByteArrayTag, StringTag, ListTag, CompoundTag
+def find_invalid_byte(data, table):
+    """Returns the offset of the first byte in data that the given table
+    marks as invalid, or -1 if every byte is valid."""
+    return data.translate(table).find("\x01")
+
+def block_index_to_pos(index):
+    """Converts an index into a chunk's Blocks array to (x, y, z)."""
+    return index >> 11, index & 127, (index >> 7) & 15
+
+# Chunk validation schema
+#
+# The layout of a chunk is described with the tables below, which are
+# compiled once into plain closures by compile_compound() and friends. A
+# compound tag is described by a list of (name, tag class, check) fields; the
+# child must exist and be of the given class, and then check (if not None) is
+# called as check(validator, parent, child). To support a new entity or tile
+# entity type, add it to entity_types or tile_entity_types and call
+# ChunkValidator.compile().
+
+# Messages for a missing child tag, formatted with the name and parent path
+MISSING_TAG = "Missing tag '{0}' in '{1}'"
+MISSING_CHILD = "Expected '{1}' to contain an '{0}' child tag"
+
+# Tags do not know their own name or parent, so the validator keeps the names
+# of the tags being checked on a stack (validator.names). Every check is
+# called with the name of its tag on top of the stack.
+
+def tag_path(validator):
+    """Returns the path of the tag that is being checked."""
+    return "root" + ".".join(validator.names)
+
+def parent_path(validator):
+    """Returns the path of the parent of the tag that is being checked."""
+    return "root" + ".".join(validator.names[:-1])
+
+def expect(validator, cond, msg):
+    if not cond:
+        raise ValidationError("Expected '{0}' ".format(tag_path(validator)) + msg)
+
+def expect_tag_type(validator, tag, cls):
+    if not isinstance(tag, cls):
+        raise ValidationError("Expected '{0}' to be a {1}".format(tag_path(validator), cls))
+
+def fail(validator, e, tag_path):
+    """Handles a ValidationError raised while checking the tag at tag_path.
+    The error is raised again, unless the validator collects all errors, in
+    which case it is recorded and checking carries on with the next tag."""
+    if e.tag_path == None:
+        e.tag_path = tag_path
+    if validator.errors == None:
+        raise e
+    validator.errors.append(e)
+
+def compile_compound(fields, missing=MISSING_CHILD, timed=False):
+    """Compiles a list of fields into a check for a compound tag. If timed is
+    set, the time spent in each field's check is recorded when profiling."""
+    fields = tuple(fields)
+    def check_compound(validator, parent, tag):
+        if not isinstance(tag, CompoundTag):
+            expect_tag_type(validator, tag, CompoundTag)
+        data = tag.data
+        names = validator.names
+        for name, cls, check in fields:
+            child = data.get(name)
+            if child == None:
+                path = tag_path(validator)
+                fail(validator, ValidationError(missing.format(name, path)),
+                     path + "." + name)
+                continue
+            if not isinstance(child, cls) or check != None:
+                names.append(name)
+                try:
+                    expect_tag_type(validator, child, cls)
+                    if check == None:
+                        continue
+                    if timed and validator.timings != None:
+                        validator.call_check(check, tag, child)
+                    else:
+                        check(validator, tag, child)
+                except ValidationError, e:
+                    fail(validator, e, tag_path(validator))
+                finally:
+                    names.pop()
+    return check_compound
+
+def compile_list(check):
+    """Compiles a check that applies another check to every list element."""
+    def check_list(validator, parent, tag):
+        names = validator.names
+        for i, child in enumerate(tag.data):
+            names.append(str(i))
+            try:
+                check(validator, tag, child)
+            except ValidationError, e:
+                fail(validator, e, tag_path(validator))
+            finally:
+                names.pop()
+    return check_list
+
+def compile_typed(types, common_fields, kind, allowed):
+    """Compiles a check for compound tags that are told apart by their 'id'
+    child, such as entities. Only the ids in allowed are accepted. types maps
+    ids to their list of fields, and common_fields are checked for every known
+    id before the fields of its type, so that an unknown id is reported as
+    such rather than as whatever common field it lacks."""
+    check_common = compile_compound(common_fields)
+    checks = {}
+    for id in allowed:
+        checks[id] = compile_compound(types.get(id, []))
+    def check_typed(validator, parent, tag):
+        if not isinstance(tag, CompoundTag):
+            expect_tag_type(validator, tag, CompoundTag)
+        expect(validator, 'id' in tag.data, "to contain an 'id' child tag")
+        id = tag.data['id'].data
+        check = checks.get(id)
+        if check == None:
+            raise ValidationError("Unknown {0} type '{1}' in '{2}'"
+                    .format(kind, id, tag_path(validator)))
+        check_common(validator, parent, tag)
+        check(validator, parent, tag)
+    return check_typed
+
+def check_blocks(validator, parent, tag):
+    expect(validator, len(tag) == 32768, "to be 32768 bytes long")
+    i = find_invalid_byte(tag.data, validator.block_id_table)
+    if i != -1:
+        block_id = validator.byte_fmt.unpack(tag.data[i])[0]
+        x, y, z = block_index_to_pos(i)
+        raise ValidationError("Invalid block ID: {0} at offset {1} (x={2}, y={3}, z={4})"
+                .format(block_id, i, x, y, z))
+
+# Deep checks
+#
+# With the deep option, the nibble arrays and the HeightMap are checked
+# against Blocks too. These work on whole arrays with str.translate(),
+# str.count() and slicing so that no Python code runs per block.
+
+# Blocks that certainly stop light (the game's light opacity is not 0), and
+# so must be at or below the HeightMap. Blocks not listed here may or may not.
+light_blocking_blocks = frozenset([
+    1, 2, 3, 4, 5, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 21, 22,
+    23, 24, 25, 35, 41, 42, 43, 45, 46, 47, 48, 49, 56, 57, 58, 61, 62, 73,
+    74, 79, 80, 82, 84, 86, 87, 88, 89, 91,
+])
+
+# Valid Data values of the blocks that only use some of them
+block_data_values = {
+    6: [v for v in xrange(16) if v & 3 != 3], # Sapling; 8 is a growth flag
+    17: range(3), # Log
+    18: [v for v in xrange(16) if v & 3 != 3], # Leaves; 4 and 8 are decay flags
+    43: range(4), 44: range(4), # Slabs
+    50: range(6), 75: range(6), 76: range(6), # Torches
+    53: range(4), 67: range(4), # Stairs
+    59: range(8), # Crops
+    60: range(9), # Farmland
+    23: range(6), 61: range(6), 62: range(6), 65: range(6), 68: range(6),
+    66: range(10), # Rails
+    69: [v for v in xrange(16) if v & 7 <= 6], # Lever; 8 is the powered flag
+    77: [v for v in xrange(16) if v & 7 <= 4], # Button; 8 is the pressed flag
+    86: range(4), 91: range(4), # Pumpkins
+    92: range(6), # Cake
+}
+
+def build_data_tables(values):
+    """Groups the blocks of block_data_values by their valid values. Returns
+    a translation table that maps a block ID to the hex digit of its group
+    (0 for blocks with no restrictions) and a table for find_invalid_byte()
+    over (group << 4 | data value) bytes."""
+    groups = [None]
+    for id in sorted(values):
+        if frozenset(values[id]) not in groups:
+            groups.append(frozenset(values[id]))
+    assert len(groups) <= 16
+    group_table = "".join(["%x" % (groups.index(frozenset(values[i])) if i in values else 0)
+                           for i in xrange(256)])
+    value_table = build_byte_table(lambda i: i >> 4 == 0 or i >> 4 >= len(groups) or
+                                             (i & 15) in groups[i >> 4])
+    return group_table, value_table
+
+block_data_group_table, block_data_value_table = build_data_tables(block_data_values)
+light_blocking_table = build_byte_table(lambda id: id not in light_blocking_blocks)
+non_air_table = build_byte_table(lambda id: id == 0)
+
+def nibble_hex(data):
+    """Returns the nibbles of a nibble array as a string of hex digits, so
+    that character i is nibble i (the low nibble of a byte comes first)."""
+    hex = binascii.hexlify(data)
+    nibbles = bytearray(len(hex))
+    nibbles[0::2] = hex[1::2]
+    nibbles[1::2] = hex[0::2]
+    return str(nibbles)
+
+def get_blocks(parent):
+    """Returns the Blocks of a Level for the deep checks, or None if they are
+    missing or broken (which check_blocks reports)."""
+    blocks = parent.data.get('Blocks')
+    if not isinstance(blocks, ByteArrayTag) or len(blocks) != 32768:
+        return None
+    return blocks.data
+
+def check_data(validator, parent, tag):
+    expect(validator, len(tag) == 16384, "to be 16384 bytes long")
+    if not validator.deep:
+        return
+    blocks = get_blocks(parent)
+    if blocks == None:
+        return
+    # Pair up each block's group and data value as two hex digits
+    pairs = bytearray(65536)
+    pairs[0::2] = blocks.translate(block_data_group_table)
+    pairs[1::2] = nibble_hex(tag.data)
+    i = find_invalid_byte(binascii.unhexlify(pairs), block_data_value_table)
+    if i != -1:
+        x, y, z = block_index_to_pos(i)
+        raise ValidationError("Invalid data value {0} for block ID {1} at offset {2} "
+                "(x={3}, y={4}, z={5})".format(int(chr(pairs[i * 2 + 1]), 16),
+                                               ord(blocks[i]), i, x, y, z))
+
+def get_heights(parent):
+    height_map = parent.data.get('HeightMap')
+    if not isinstance(height_map, ByteArrayTag) or len(height_map) != 256:
+        return None
+    return height_map.data
+
+def check_sky_light(validator, parent, tag):
+    expect(validator, len(tag) == 16384, "to be 16384 bytes long")
+    if not validator.deep:
+        return
+    heights = get_heights(parent)
+    if heights == None:
+        return
+    # Everything above the HeightMap is lit by the sky
+    light = nibble_hex(tag.data)
+    for i in xrange(256):
+        x, z = i & 15, i >> 4
+        base = x << 11 | z << 7
+        height = min(ord(heights[i]), 128)
+        if light.count("f", base + height, base + 128) != 128 - height:
+            raise ValidationError("Expected full sky light above the HeightMap "
+                    "at x={0}, z={1}".format(x, z))
+
+def check_block_light(validator, parent, tag):
+    expect(validator, len(tag) == 16384, "to be 16384 bytes long")
+    # Light levels are nibbles, so they cannot be out of range; there is no
+    # deep check as block light is updated lazily by the game
+
+def check_height_map(validator, parent, tag):
+    expect(validator, len(tag) == 256, "to be 256 bytes long")
+    if not validator.deep:
+        return
+    blocks = get_blocks(parent)
+    if blocks == None:
+        return
+    blocking = blocks.translate(light_blocking_table)
+    solid = blocks.translate(non_air_table)
+    heights = tag.data
+    for i in xrange(256):
+        x, z = i & 15, i >> 4
+        base = x << 11 | z << 7
+        height = ord(heights[i])
+        # The height is above the highest block that stops light but not
+        # above the highest block of any kind
+        low = blocking.rfind("\x01", base, base + 128)
+        high = solid.rfind("\x01", base, base + 128)
+        low = low - base + 1 if low != -1 else 0
+        high = high - base + 1 if high != -1 else 0
+        if height < low or height > high:
+            raise ValidationError("HeightMap value {0} at x={1}, z={2} does not match "
+                    "the blocks, which need {3} to {4}".format(height, x, z, low, high))
+
+def check_entities(validator, parent, tag):
+    entities = tag.data
+    # Chunks hit by item duping can hold tens of thousands of entities, so the
+    # count is checked first and validation stops there unless collecting
+    if validator.max_entities and len(entities) > validator.max_entities:
+        fail(validator, TooManyEntitiesError("Chunk has {0} entities, more than {1}"
+                .format(len(entities), validator.max_entities)), tag_path(validator))
+    check = validator.check_entity
+    names = validator.names
+    for i, child in enumerate(entities):
+        names.append(str(i))
+        try:
+            check(validator, None, child)
+        except ValidationError, e:
+            fail(validator, e, tag_path(validator))
+        finally:
+            names.pop()
+
+def check_tile_entities(validator, parent, tag):
+    check = validator.check_tile_entity
+    names = validator.names
+    for i, child in enumerate(tag.data):
+        names.append(str(i))
+        try:
+            check(validator, None, child)
+        except ValidationError, e:
+            fail(validator, e, tag_path(validator))
+        finally:
+            names.pop()
+
+def check_terrain_populated(validator, parent, tag):
+    if tag.data != 0 and tag.data != 1:
+        raise ValidationError("TerrainPopulated is neither '0' nor '1'")
+
+def check_xpos(validator, parent, tag):
+    if tag.data != validator.expected_x:
+        raise ValidationError("xPos in file does not match filename")
+
+def check_zpos(validator, parent, tag):
+    if tag.data != validator.expected_z:
+        raise ValidationError("zPos in file does not match filename")
+
+def check_x_inside_chunk(validator, parent, tag):
+    x = tag.data
+    if x < validator.expected_x * 16 or x > validator.expected_x * 16 + 16:
+        raise ValidationError("Entity X coordinate is outside chunk in '{0}'"
+                .format(parent_path(validator)))
+
+def check_y_inside_chunk(validator, parent, tag):
+    if tag.data < 0 or tag.data > 127:
+        raise ValidationError("Entity Y coordinate is invalid in '{0}'"
+                .format(parent_path(validator)))
+
+def check_z_inside_chunk(validator, parent, tag):
+    z = tag.data
+    if z < validator.expected_z * 16 or z > validator.expected_z * 16 + 16:
+        raise ValidationError("Entity z coordinate is outside chunkin '{0}'"
+                .format(parent_path(validator)))
+
+def is_finite(value):
+    return not math.isnan(value) and not math.isinf(value)
+
+def expect_numbers(validator, tag, cls, count):
+    """Checks that a list tag holds count finite numbers of the given class."""
+    expect(validator, tag.tag_id == cls.type_id or (not tag.data and tag.tag_id == 0),
+           "to be a list of {0}".format(cls.__name__))
+    expect(validator, len(tag.data) == count, "to have {0} elements".format(count))
+    for child in tag.data:
+        if not is_finite(child.data):
+            raise ValidationError("Expected '{0}' to only contain finite numbers"
+                    .format(tag_path(validator)))
+
+def check_entity_pos(validator, parent, tag):
+    expect_numbers(validator, tag, DoubleTag, 3)
+    x, y, z = [child.data for child in tag.data]
+    if x < validator.expected_x * 16 or x > validator.expected_x * 16 + 16:
+        raise ValidationError("Entity X coordinate is outside chunk in '{0}'"
+                .format(parent_path(validator)))
+    if z < validator.expected_z * 16 or z > validator.expected_z * 16 + 16:
+        raise ValidationError("Entity z coordinate is outside chunkin '{0}'"
+                .format(parent_path(validator)))
+
+# Entities never move faster than this many blocks a tick in the game
+MAX_MOTION = 10.0
+
+def check_entity_motion(validator, parent, tag):
+    expect_numbers(validator, tag, DoubleTag, 3)
+    for child in tag.data:
+        if abs(child.data) > MAX_MOTION:
+            raise ValidationError("Entity motion is too fast in '{0}'"
+                    .format(parent_path(validator)))
+
+def check_entity_rotation(validator, parent, tag):
+    expect_numbers(validator, tag, FloatTag, 2)
+
+def check_sign_text(validator, parent, tag):
+    if len(tag.data) > 15:
+        raise ValidationError("Sign line is longer than 15 chars. in '{0}'"
+                .format(parent_path(validator)))
+
+def check_mob_name(validator, parent, tag):
+    if not validator.is_valid_mob_id(tag.data):
+        raise ValidationError("Invalid mob name: " + tag.data)
+
+def check_mob_spawner_delay(validator, parent, tag):
+    if tag.data < 0:
+        raise ValidationError("Mob spawner delay < 0 in '{0}'"
+                .format(parent_path(validator)))
+
+def check_chest_item_id(validator, parent, tag):
+    id = tag.data
+    table = validator.item_id_table
+    if id < 0 or id >= len(table) or not table[id]:
+        raise ValidationError("Invalid item/block chest ID: '{0}' ".format(id))
+
+item_fields = [
+    ('id', ShortTag, check_chest_item_id),
+    ('Damage', ShortTag, None),
+    ('Count', ByteTag, None),
+    ('Slot', ByteTag, None),
 ]
 
-def read_tags(reader, type_id, count, parent):
-    try: 
-        cls = tag_types[type_id]
-    except IndexError:
-        raise UnknownTagTypeError(type_id)
-    for i in xrange(count):
-        tag = cls.read(reader, parent)
-        tag.name = str(i)
-        yield tag
-
-def read_named_tags(reader, parent, check_eof=False):
-    fmt = read_named_tags.fmt
-    while True:
-        data = reader.read(fmt.size)
-        if check_eof and len(data) == 0: break
-        type_id = fmt.unpack(data)[0]
-        if type_id == 0: # Special case: end tags
-            yield None, EndTag()
-            break
+check_items = compile_list(compile_compound(item_fields))
+
+def check_item_id(validator, parent, tag):
+    id = tag.data
+    table = validator.item_id_table
+    if id < 0 or id >= len(table) or not table[id]:
+        raise ValidationError("Invalid item/block ID: '{0}' in '{1}'"
+                .format(id, parent_path(validator)))
+
+def check_item_count(validator, parent, tag):
+    if tag.data < 1 or tag.data > 64:
+        raise ValidationError("Item stack count {0} is not between 1 and 64 in '{1}'"
+                .format(tag.data, parent_path(validator)))
+
+# A single item stack, as held by a dropped item
+item_stack_fields = [
+    ('id', ShortTag, check_item_id),
+    ('Damage', ShortTag, None),
+    ('Count', ByteTag, check_item_count),
+]
+
+# Fields of each entity type. Which entity types are allowed at all comes
+# from the ID profile; types that are missing here have no extra fields.
+entity_types = {
+    'Item': [
+        ('Health', ShortTag, None),
+        ('Age', ShortTag, None),
+        ('Item', CompoundTag, compile_compound(item_stack_fields)),
+    ],
+}
+
+entity_fields = [
+    ('Pos', ListTag, check_entity_pos),
+    ('Motion', ListTag, check_entity_motion),
+    ('Rotation', ListTag, check_entity_rotation),
+    ('FallDistance', FloatTag, None),
+    ('Fire', ShortTag, None),
+    ('Air', ShortTag, None),
+    ('OnGround', ByteTag, None),
+]
+
+tile_entity_fields = [
+    ('x', IntTag, check_x_inside_chunk),
+    ('y', IntTag, check_y_inside_chunk),
+    ('z', IntTag, check_z_inside_chunk),
+]
+
+tile_entity_types = {
+    'Furnace': [('BurnTime', ShortTag, None)],
+    'Sign': [
+        ('Text1', StringTag, check_sign_text),
+        ('Text2', StringTag, check_sign_text),
+        ('Text3', StringTag, check_sign_text),
+        ('Text4', StringTag, check_sign_text),
+    ],
+    'MobSpawner': [
+        ('EntityId', StringTag, check_mob_name),
+        ('Delay', ShortTag, check_mob_spawner_delay),
+    ],
+    'Chest': [('Items', ListTag, check_items)],
+    'Trap': [('Items', ListTag, check_items)],
+    'Music': [('note', ByteTag, None)],
+}
+
+# ID profiles
+#
+# The valid block IDs, item IDs, mob names, entity types and tile entity types
+# of a game version. An ID entry is either a single ID or an inclusive
+# (first, last) range. A profile that "extends" another one adds to it.
+# Profiles can also be loaded from a JSON file of the same shape, which is the
+# way to check modded worlds.
+id_profiles = {
+    'alpha-1.2': {
+        'blocks': [(0, 20), 35, (37, 91)],
+        'items': [(256, 350), (2256, 2257)],
+        'mobs': [
+            'Mob', 'Monster', 'Creeper', 'Skeleton', 'Spider', 'Giant',
+            'Zombie', 'Slime', 'PigZombie', 'Ghast', 'Pig', 'Sheep', 'Cow',
+            'Chicken',
+        ],
+        'entities': [
+            'Item', 'Arrow', 'Snowball', 'Egg', 'Painting', 'Minecart', 'Boat',
+            'PrimedTnt', 'FallingSand',
+        ],
+        'tile_entities': ['Furnace', 'Sign', 'MobSpawner', 'Chest'],
+    },
+    'beta-1.2': {
+        'extends': 'alpha-1.2',
+        'blocks': [(21, 25), 92],
+        'items': [(351, 354)],
+        'mobs': ['Squid'],
+        'tile_entities': ['Trap', 'Music'],
+    },
+    'beta-1.3': {
+        'extends': 'beta-1.2',
+        'blocks': [26, 93, 94],
+        'items': [355, 356],
+    },
+}
+
+DEFAULT_ID_PROFILE = 'beta-1.2'
+
+# Chunks with more entities than this are reported; 0 turns the check off
+DEFAULT_MAX_ENTITIES = 1000
+
+# Chunks that decompress to more than this many bytes are rejected
+DEFAULT_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+def expand_ids(entries):
+    """Expands a list of IDs and (first, last) ranges into a set."""
+    ids = set()
+    for entry in entries:
+        if isinstance(entry, (list, tuple)):
+            ids.update(xrange(entry[0], entry[1] + 1))
         else:
-            name = StringTag.read(reader, None).data
+            ids.add(entry)
+    return ids
+
+class IdProfile(object):
+    """The resolved sets of valid IDs of a profile. Block and item IDs also
+    get lookup tables so that checking one is a single index operation."""
+    def __init__(self, name, blocks, items, mobs, entities, tile_entities):
+        self.name = name
+        self.blocks = frozenset(blocks)
+        self.items = frozenset(items) | self.blocks # Blocks can be items too
+        self.mobs = frozenset(mobs)
+        self.entities = frozenset(entities) | self.mobs
+        self.tile_entities = frozenset(tile_entities)
+        self.block_id_table = build_byte_table(lambda id: id in self.blocks)
+        self.item_id_table = bytearray(max(self.items) + 1 if self.items else 0)
+        for id in self.items:
+            if id >= 0:
+                self.item_id_table[id] = 1
+
+def load_id_profile(name, seen=()):
+    """Loads a built-in profile by name, or a profile from a JSON file."""
+    if name in seen:
+        raise CheckerException("ID profile '{0}' extends itself".format(name))
+    if name in id_profiles:
+        data = id_profiles[name]
+    else:
+        try:
+            f = open(name, "rb")
             try:
-                cls = tag_types[type_id]
-            except IndexError:
-                raise UnknownTagTypeError(type_id)
-            tag = cls.read(reader, parent)
-            tag.name = name
-            yield name, tag
-read_named_tags.fmt = Struct("b")
-
-def get_path(tag):
-    path = []
-    cur = tag
-    while cur != None:
-        path.insert(0, cur.name)
-        cur = cur.parent
-    return "root" + ".".join(path)
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            raise CheckerException("Could not load ID profile '{0}': {1}".format(name, e))
+    sets = {}
+    for key in ('blocks', 'items'):
+        sets[key] = expand_ids(data.get(key, []))
+    for key in ('mobs', 'entities', 'tile_entities'):
+        sets[key] = set(data.get(key, []))
+    if data.get('extends'):
+        base = load_id_profile(data['extends'], seen + (name,))
+        sets['blocks'] |= base.blocks
+        sets['items'] |= base.items - base.blocks
+        sets['mobs'] |= base.mobs
+        sets['entities'] |= base.entities - base.mobs
+        sets['tile_entities'] |= base.tile_entities
+    return IdProfile(name, **sets)
+
+level_fields = [
+    ('Blocks', ByteArrayTag, check_blocks),
+    ('Data', ByteArrayTag, check_data),
+    ('SkyLight', ByteArrayTag, check_sky_light),
+    ('BlockLight', ByteArrayTag, check_block_light),
+    ('HeightMap', ByteArrayTag, check_height_map),
+    ('Entities', ListTag, check_entities),
+    ('TileEntities', ListTag, check_tile_entities),
+    ('LastUpdate', LongTag, None),
+    ('TerrainPopulated', ByteTag, check_terrain_populated),
+    ('xPos', IntTag, check_xpos),
+    ('zPos', IntTag, check_zpos),
+]
+
+class CompiledSchema(object):
+    """The checks compiled from the schema tables for one ID profile."""
+    def __init__(self, profile):
+        self.profile = profile
+        self.check_entity = compile_typed(entity_types, entity_fields, "entity",
+                                          profile.entities)
+        self.check_tile_entity = compile_typed(tile_entity_types, tile_entity_fields,
+                                               "tile entity", profile.tile_entities)
+        self.check_level = compile_compound(level_fields, MISSING_TAG, timed=True)
+        self.check_root = compile_compound([('Level', CompoundTag, self.check_level)],
+                                           MISSING_TAG)
 
 class ChunkValidator(object):
     byte_fmt = Struct(">b")
     filename_match = re.compile(r"c\.(\-?[a-z0-9]+)\.(\-?[a-z0-9]+)\.dat$")
+    # Tags that are read in lazy mode; anything else in Level is skipped
+    schema = {"*": {"Level": dict.fromkeys([f[0] for f in level_fields])}}
+    # Compiled schemas by ID profile name
+    compiled = {}
 
-    def __init__(self, path):
+    @classmethod
+    def compile(cls, id_profile=DEFAULT_ID_PROFILE):
+        """Compiles the schema tables for an ID profile. This happens the first
+        time a profile is used; call it again after changing the tables."""
+        cls.compiled[id_profile] = CompiledSchema(load_id_profile(id_profile))
+        return cls.compiled[id_profile]
+
+    def __init__(self, path, lazy=False, engine="stream", coords=None,
+                 compression="gzip", id_profile=DEFAULT_ID_PROFILE, collect=False,
+                 max_entities=DEFAULT_MAX_ENTITIES, deep=False,
+                 max_size=DEFAULT_MAX_CHUNK_SIZE):
         self.path = path
+        self.lazy = lazy
+        self.engine = engine
+        self.compression = compression
+        compiled = self.compiled.get(id_profile) or self.compile(id_profile)
+        self.check_entity = compiled.check_entity
+        self.check_tile_entity = compiled.check_tile_entity
+        self.check_root = compiled.check_root
+        self.block_id_table = compiled.profile.block_id_table
+        self.item_id_table = compiled.profile.item_id_table
+        self.mob_ids = compiled.profile.mobs
+        # Set to a dict to collect the time spent in each phase and validator
+        self.timings = None
+        # With collect set, validation errors are gathered here instead of
+        # stopping validation at the first one
+        self.errors = [] if collect else None
+        # Names of the tags from the root down to the one being checked
+        self.names = []
+        self.max_entities = max_entities
+        self.deep = deep
+        self.max_size = max_size
+        # What the cross-chunk checks need to know, once the chunk is read
+        self.facts = None
+        if coords != None: # Chunks inside region files have no filename
+            self.expected_x, self.expected_z = coords
+            return
         m = self.filename_match.search(path)
         if not m:
             raise ValidationError("Invalid filename: " + path)
@@ -169,230 +715,1497 @@ class ChunkValidator(object):
             raise ValidationError("Invalid filename (invalid coordinate): " + path)
     
     def is_valid_mob_id(self, name):
-        return name == 'Mob'\
-            or name == 'Monster'\
-            or name == 'Creeper'\
-            or name == 'Skeleton'\
-            or name == 'Spider'\
-            or name == 'Giant'\
-            or name == 'Zombie'\
-            or name == 'Slime'\
-            or name == 'PigZombie'\
-            or name == 'Ghast'\
-            or name == 'Pig'\
-            or name == 'Sheep'\
-            or name == 'Cow'\
-            or name == 'Chicken'\
-            or name == 'Squid'
-    
-    def expect(self, tag, cond, msg):
-        if not cond:
-            raise ValidationError("Expected '{0}' ".format(get_path(tag)) + msg)
-    
-    def expect_valid_chest_item_id(self, tag, id):
-        if id < 0 or (id >= 26 and id <= 34)\
-                or id == 36\
-                or (id >= 93 and id <= 255)\
-                or (id >= 355 and id <= 2255)\
-                or id >= 2258:
-            raise ValidationError("Invalid item/block chest ID: '{0}' ".format(id))
-    
-    def expect_tag_type(self, tag, cls):
-        if not isinstance(tag, cls):
-            raise ValidationError("Expected '{0}' to be a {1}".format(get_path(tag), cls))
-    
-    def expect_compound_children(self, tag, validators):
-        self.expect_tag_type(tag, CompoundTag)
-        for name in validators:
-            if name not in tag:
-                raise ValidationError("Missing tag '{0}' in '{1}'".format(name, get_path(tag)))
-            validators[name](tag[name])
-    
-    def expect_child_value(self, tag, name, cls, validate_func=None):
-        self.expect(tag, name in tag, "to contain an '{0}' child tag".format(name))
-        self.expect_tag_type(tag[name], cls)
-        if validate_func != None:
-            validate_func(tag, tag[name].data)
-    
-    def expect_x_inside_chunk(self, tag, x):
-        if x < self.expected_x * 16 or x > self.expected_x * 16 + 16:
-            raise ValidationError("Entity X coordinate is outside chunk in '{0}'"
-                    .format(get_path(tag)))
-    
-    def expect_y_inside_chunk(self, tag, y):
-        if y < 0 or y > 127:
-            raise ValidationError("Entity Y coordinate is invalid in '{0}'"
-                    .format(get_path(tag)))
-    
-    def expect_z_inside_chunk(self, tag, z):
-        if z < self.expected_z * 16 or z > self.expected_z * 16 + 16:
-            raise ValidationError("Entity z coordinate is outside chunkin '{0}'"
-                    .format(get_path(tag)))
-    
-    def expect_valid_sign_text(self, tag, text):
-        if len(text) > 15:
-            raise ValidationError("Sign line is longer than 15 chars. in '{0}'"
-                    .format(get_path(tag)))
-    
-    def expect_valid_mob_name(self, tag, mob_name):
-        if not self.is_valid_mob_id(mob_name):
-            raise ValidationError("Invalid mob name: " + mob_name)
-    
-    def expect_valid_mob_spawner_delay(self, tag, delay):
-        if delay < 0:
-            raise ValidationError("Mob spawner delay < 0 in '{0}'"
-                    .format(get_path(tag)))
-    
-    def expected_valid_chest_items(self, tag, items):
-        for item in items:
-            self.expect_tag_type(item, CompoundTag)
-            self.expect_child_value(item, "id", ShortTag, self.expect_valid_chest_item_id)
-            self.expect_child_value(item, "Damage", ShortTag)
-            self.expect_child_value(item, "Count", ByteTag)
-            self.expect_child_value(item, "Slot", ByteTag)
+        return name in self.mob_ids
+    
+    def call_check(self, check, parent, tag):
+        start = time.time()
+        try:
+            check(self, parent, tag)
+        finally:
+            self.add_time(check.__name__, time.time() - start)
+    
+    def add_time(self, key, elapsed):
+        self.timings[key] = self.timings.get(key, 0.0) + elapsed
     
     def validate_entity(self, tag):
-        self.expect_tag_type(tag, CompoundTag)
-        self.expect(tag, 'id' in tag, "to contain an 'id' child tag")
-        id = tag['id'].data
-        if self.is_valid_mob_id(id):
-            pass # TODO: Validation
-        elif id == 'Item' or id == 'Arrow' or id == 'Snowball'\
-                or id == 'Egg' or id == 'Painting':
-            pass # TODO: Validation
-        elif id == 'Minecart' or id == 'Boat':
-            pass # TODO: Validation
-        elif id == 'PrimedTnt' or id == 'FallingSand':
-            pass # TODO: Validation
-        else:
-            raise ValidationError("Unknown entity type '{0}' in '{1}'"
-                    .format(id, get_path(tag)))
+        self.check_entity(self, None, tag)
     
     def validate_tile_entity(self, tag):
-        self.expect_tag_type(tag, CompoundTag)
-        self.expect(tag, 'id' in tag, "to contain an 'id' child tag")
-        self.expect_child_value(tag, 'x', IntTag, self.expect_x_inside_chunk)
-        self.expect_child_value(tag, 'y', IntTag, self.expect_y_inside_chunk)
-        self.expect_child_value(tag, 'z', IntTag, self.expect_z_inside_chunk)
-        id = tag['id'].data
-        if id == 'Furnace':
-            self.expect_child_value(tag, "BurnTime", ShortTag)
-        elif id == 'Sign':
-            self.expect_child_value(tag, "Text1", StringTag, self.expect_valid_sign_text)
-            self.expect_child_value(tag, "Text2", StringTag, self.expect_valid_sign_text)
-            self.expect_child_value(tag, "Text3", StringTag, self.expect_valid_sign_text)
-            self.expect_child_value(tag, "Text4", StringTag, self.expect_valid_sign_text)
-        elif id == 'MobSpawner':
-            self.expect_child_value(tag, "EntityId", StringTag, self.expect_valid_mob_name)
-            self.expect_child_value(tag, "Delay", ShortTag, self.expect_valid_mob_spawner_delay)
-        elif id == 'Chest':
-            self.expect_child_value(tag, "Items", ListTag, self.expected_valid_chest_items)
-        elif id == 'Trap':
-             self.expect_child_value(tag, "Items", ListTag, self.expected_valid_chest_items)
-        elif id == 'Music':
-             self.expect_child_value(tag, "note", ByteTag)
-        else:
-            raise ValidationError("Unknown tile entity type '{0}' in '{1}'"
-                    .format(id, get_path(tag)))
-    
-    def validate_blocks(self, tag):
-        self.expect_tag_type(tag, ByteArrayTag)
-        self.expect(tag, len(tag.data) == 32768, "to be 32768 bytes long")
-        for i in xrange(0, len(tag.data)):
-            block_id = self.byte_fmt.unpack(tag.data[i])[0]
-            if block_id < 0 or (block_id >= 26 and block_id <= 34)\
-                    or block_id == 36 or block_id >= 93:
-                raise ValidationError("Invalid block ID: {0}".format(block_id))
-    
-    def validate_data(self, tag):
-        self.expect_tag_type(tag, ByteArrayTag)
-        self.expect(tag, len(tag.data) == 16384, "to be 16384 bytes long")
-        # NOTE: Does not do deep checking
-    
-    def validate_sky_light(self, tag):
-        self.expect_tag_type(tag, ByteArrayTag)
-        self.expect(tag, len(tag.data) == 16384, "to be 16384 bytes long")
-        # NOTE: Does not do deep checking (does it matter?)
-    
-    def validate_block_light(self, tag):
-        self.expect_tag_type(tag, ByteArrayTag)
-        self.expect(tag, len(tag.data) == 16384, "to be 16384 bytes long")
-        # NOTE: Does not do deep checking (does it matter?)
-    
-    def validate_height_map(self, tag):
-        self.expect_tag_type(tag, ByteArrayTag)
-        self.expect(tag, len(tag.data) == 256, "to be 256 bytes long")
-        # NOTE: Does not do deep checking (does it matter?)
-    
-    def validate_entities(self, tag):
-        self.expect_tag_type(tag, ListTag)
-        for child in tag:
-            self.validate_entity(child)
-    
-    def validate_tile_entities(self, tag):
-        self.expect_tag_type(tag, ListTag)
-        for child in tag:
-            self.validate_tile_entity(child)
-    
-    def validate_last_update(self, tag):
-        self.expect_tag_type(tag, LongTag)
-    
-    def validate_terrain_populated(self, tag):
-        self.expect_tag_type(tag, ByteTag)
-        if tag.data != 0 and tag.data != 1:
-            raise ValidationError("TerrainPopulated is neither '0' nor '1'")
-    
-    def validate_xpos(self, tag):
-        self.expect_tag_type(tag, IntTag)
-        if tag.data != self.expected_x:
-            raise ValidationError("xPos in file does not match filename")
-    
-    def validate_zpos(self, tag):
-        self.expect_tag_type(tag, IntTag)
-        if tag.data != self.expected_z:
-            raise ValidationError("zPos in file does not match filename")
-
-    def validate_level_tag(self, tag):
-        self.expect_compound_children(tag, {
-            'Blocks': self.validate_blocks,
-            'Data': self.validate_data,
-            'SkyLight': self.validate_sky_light,
-            'BlockLight': self.validate_block_light,
-            'HeightMap': self.validate_height_map,
-            'Entities': self.validate_entities,
-            'TileEntities': self.validate_tile_entities,
-            'LastUpdate': self.validate_last_update,
-            'TerrainPopulated': self.validate_terrain_populated,
-            'xPos': self.validate_xpos,
-            'zPos': self.validate_zpos,
-        })
-        
-    def validate_root_tag(self, tag):
-        self.expect_compound_children(tag, {
-            'Level': self.validate_level_tag,
-        })
+        self.check_tile_entity(self, None, tag)
+    
+    def validate_root_tag(self, tag, name=""):
+        self.names.append(name)
+        try:
+            self.check_root(self, None, tag)
+        finally:
+            self.names.pop()
 
-    def validate(self):
-        f = gzip.open(self.path, 'rb')
-        reader = io.BufferedReader(f)
+    def read_root_tags(self, data=None):
+        """Decodes the chunk with the configured engine and returns an
+        iterable of (name, tag) tuples for its root tags. data is the raw
+        (compressed) file contents; the file is read if it is not given."""
+        schema = self.schema if self.lazy else None
+        if data == None:
+            data = open(self.path, 'rb')
+        # The stream adds the time spent decompressing to the timings itself,
+        # as decompression is interleaved with parsing in the stream engine
+        stream = ChunkStream(data, self.compression, self.max_size, self.timings)
+        if self.engine != "fast" and not self.lazy:
+            return read_named_tags(io.BufferedReader(stream), check_eof=True)
+        buf = stream.readall()
+        if self.engine == "fast":
+            return FastDecoder(buf, self.lazy).read_named_tags(0, schema,
+                                                               check_eof=True)[0]
+        reader = BufferReader(buf, lazy=self.lazy)
+        return read_named_tags(reader, check_eof=True, schema=schema)
+
+    def validate_root_tags(self, tags):
         found = 0
-        for name, tag in read_named_tags(reader, None, check_eof=True):
+        for name, tag in tags:
             if not isinstance(tag, CompoundTag):
                 raise UnexpectedTagError("Root tag expected to be a compound tag")
             if found != 0:
                 raise UnexpectedTagError("Only one root tag expected")
-            self.validate_root_tag(tag)
+            self.validate_root_tag(tag, name)
             found = found + 1
 
+    def gather_facts(self, tags):
+        """Returns the chunk's [xPos, zPos, chunks] for the cross-chunk checks,
+        where chunks lists the [x, z] of the other chunks that its tile
+        entities lie in. Anything that cannot be read is left out (None)."""
+        x_pos = z_pos = None
+        elsewhere = set()
+        level = tags[0][1].data.get('Level') if tags and isinstance(tags[0][1], CompoundTag) else None
+        if isinstance(level, CompoundTag):
+            level = level.data
+            if isinstance(level.get('xPos'), IntTag):
+                x_pos = level['xPos'].data
+            if isinstance(level.get('zPos'), IntTag):
+                z_pos = level['zPos'].data
+            if isinstance(level.get('TileEntities'), ListTag):
+                for tag in level['TileEntities'].data:
+                    if not isinstance(tag, CompoundTag):
+                        continue
+                    x, z = tag.data.get('x'), tag.data.get('z')
+                    if isinstance(x, IntTag) and isinstance(z, IntTag):
+                        coords = (x.data >> 4, z.data >> 4)
+                        if coords != (self.expected_x, self.expected_z):
+                            elsewhere.add(coords)
+        return [x_pos, z_pos, [list(coords) for coords in sorted(elsewhere)]]
+
+    def validate(self, data=None):
+        if self.timings == None:
+            tags = list(self.read_root_tags(data))
+            self.facts = self.gather_facts(tags)
+            self.validate_root_tags(tags)
+        else:
+            start = time.time()
+            decompress = self.timings.get("decompress", 0.0)
+            tags = list(self.read_root_tags(data))
+            decompress = self.timings.get("decompress", 0.0) - decompress
+            self.add_time("parse", time.time() - start - decompress)
+            self.facts = self.gather_facts(tags)
+            start = time.time()
+            try:
+                self.validate_root_tags(tags)
+            finally:
+                self.add_time("validate", time.time() - start)
+
+class ChunkStream(io.RawIOBase):
+    """Decompresses a gzip or zlib chunk through zlib.decompressobj() a block
+    at a time. Decompression stops with a DecompressionError once the output
+    grows past max_size, which guards against decompression bombs. Errors
+    give the offset in the compressed data where the stream broke, and the
+    CRC-32 and size in the gzip trailer are checked as the data goes by.
+    source is either the compressed data or a file to read it from; a file is
+    closed once the stream has been read to the end. Wrap the stream in an
+    io.BufferedReader for small reads, or call readall() to get everything.
+    If a timings dict is given, the time spent decompressing is added to its
+    'decompress' key."""
+    block_size = 65536
+    gzip_header_fmt = Struct("<BBBBIBB")
+    gzip_extra_fmt = Struct("<H")
+    gzip_trailer_fmt = Struct("<II")
+
+    def __init__(self, source, compression="gzip", max_size=DEFAULT_MAX_CHUNK_SIZE,
+                 timings=None):
+        self.timings = timings
+        if hasattr(source, "read"):
+            self.f, self.data = source, None
+        else:
+            self.f, self.data = None, source
+        self.compression = compression
+        self.max_size = max_size
+        self.pos = 0 # Compressed bytes taken from the source
+        self.size = 0 # Decompressed bytes so far
+        self.crc = 0
+        self.ended = False # Set when the end of the deflate stream is seen
+        self.done = False
+        self.trailer = ""
+        self.pending = ""
+        self.pending_pos = 0
+        self.input = ""
+        self.input_start = 0 # Compressed offset of input
+        if compression == "gzip":
+            self.d = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.read_gzip_header()
+        else:
+            self.d = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def read_source(self, size):
+        if self.f != None:
+            data = self.f.read(size)
+        else:
+            data = self.data[self.pos:self.pos + size]
+        self.pos = self.pos + len(data)
+        return data
+
+    def read_gzip_header(self):
+        block = self.read_source(self.block_size)
+        if len(block) < self.gzip_header_fmt.size:
+            raise DecompressionError("Gzip header is incomplete", 0)
+        magic1, magic2, method, flags = self.gzip_header_fmt.unpack_from(block)[:4]
+        if magic1 != 0x1f or magic2 != 0x8b:
+            raise DecompressionError("Not a gzipped file", 0)
+        if method != 8:
+            raise DecompressionError("Unknown gzip compression method {0}".format(method), 2)
+        i = self.gzip_header_fmt.size
+        if flags & 4 and i + 2 <= len(block): # FEXTRA
+            i = i + 2 + self.gzip_extra_fmt.unpack_from(block, i)[0]
+        for flag in (8, 16): # FNAME, FCOMMENT
+            if flags & flag:
+                i = block.find("\x00", i) + 1 or len(block) + 1
+        if flags & 2: # FHCRC
+            i = i + 2
+        if i > len(block):
+            raise DecompressionError("Gzip header is incomplete", len(block))
+        self.input = block[i:]
+        self.input_start = i
+
+    def locate_error(self, d, data, start, e):
+        """Finds the offset of the byte that made zlib fail by feeding the
+        data again one byte at a time to a copy of the state from before."""
+        for i in xrange(len(data)):
+            try:
+                d.decompress(data[i])
+            except zlib.error:
+                break
+        else:
+            i = 0
+        return DecompressionError("Corrupt compressed data at offset {0}: {1}"
+                .format(start + i, e), start + i)
+
+    def read_piece(self):
+        """Returns the next piece of decompressed data, or "" at the end."""
+        if self.timings == None:
+            return self.decompress_piece()
+        start = time.time()
+        try:
+            return self.decompress_piece()
+        finally:
+            self.timings["decompress"] = self.timings.get("decompress", 0.0) + \
+                time.time() - start
+
+    def decompress_piece(self):
+        while not self.ended:
+            if not self.input:
+                self.input_start = self.pos
+                self.input = self.read_source(self.block_size)
+                if not self.input:
+                    self.check_ended()
+                    break
+            before = self.d.copy()
+            try:
+                out = self.d.decompress(self.input,
+                                        min(self.block_size, self.max_size - self.size + 1))
+            except zlib.error, e:
+                raise self.locate_error(before, self.input, self.input_start, e)
+            tail = self.d.unconsumed_tail
+            self.input_start = self.input_start + len(self.input) - len(tail)
+            self.input = tail
+            if self.d.unused_data:
+                self.ended = True
+                self.trailer = self.d.unused_data
+            if out:
+                self.size = self.size + len(out)
+                if self.size > self.max_size:
+                    raise DecompressionError("Chunk decompresses to more than {0} bytes"
+                            .format(self.max_size), self.input_start)
+                if self.compression == "gzip":
+                    self.crc = zlib.crc32(out, self.crc)
+                return out
+        self.finish()
+        return ""
+
+    def check_ended(self):
+        """Called when the compressed data runs out before zlib has reported
+        the end of the stream, which it only does if data follows the end."""
+        probe = self.d.copy()
+        try:
+            probe.decompress("\x00")
+        except zlib.error:
+            pass
+        if probe.unused_data != "\x00":
+            raise DecompressionError("Compressed data ends early at offset {0}"
+                    .format(self.pos), self.pos)
+        self.ended = True
+
+    def finish(self):
+        if self.compression == "gzip":
+            size = self.gzip_trailer_fmt.size
+            while len(self.trailer) < size:
+                data = self.read_source(size - len(self.trailer))
+                if not data:
+                    raise DecompressionError("Gzip trailer is incomplete at offset {0}"
+                            .format(self.pos), self.pos)
+                self.trailer = self.trailer + data
+            crc, isize = self.gzip_trailer_fmt.unpack_from(self.trailer)
+            if crc != self.crc & 0xffffffff:
+                raise DecompressionError("CRC check failed: {0:#x} in the trailer, {1:#x} "
+                        "decompressed".format(crc, self.crc & 0xffffffff), self.pos)
+            if isize != self.size & 0xffffffff:
+                raise DecompressionError("Size check failed: {0} in the trailer, {1} "
+                        "decompressed".format(isize, self.size), self.pos)
+        self.done = True
+        if self.f != None:
+            self.f.close()
+
+    def readinto(self, b):
+        while self.pending_pos >= len(self.pending):
+            if self.done:
+                return 0
+            self.pending = self.read_piece()
+            self.pending_pos = 0
+        n = min(len(b), len(self.pending) - self.pending_pos)
+        b[:n] = self.pending[self.pending_pos:self.pending_pos + n]
+        self.pending_pos = self.pending_pos + n
+        return n
+
+    def readall(self):
+        pieces = [self.pending[self.pending_pos:]]
+        self.pending = ""
+        while not self.done:
+            pieces.append(self.read_piece())
+        return "".join(pieces)
+
+class RunProfile(object):
+    """Collects the per-chunk timings of a run into a histogram for each
+    phase and keeps track of the slowest chunks."""
+    # Upper bounds of the histogram buckets, in seconds
+    bounds = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+    def __init__(self, slowest=10):
+        self.phases = {}
+        self.chunks = 0
+        self.slowest_count = slowest
+        self.slowest = []
+
+    def add(self, path, size, timings):
+        self.chunks = self.chunks + 1
+        for key in timings:
+            elapsed = timings[key]
+            phase = self.phases.get(key)
+            if phase == None:
+                phase = {'count': 0, 'total': 0.0, 'max': 0.0,
+                         'buckets': [0] * (len(self.bounds) + 1)}
+                self.phases[key] = phase
+            phase['count'] = phase['count'] + 1
+            phase['total'] = phase['total'] + elapsed
+            phase['max'] = max(phase['max'], elapsed)
+            i = 0
+            while i < len(self.bounds) and elapsed > self.bounds[i]:
+                i = i + 1
+            phase['buckets'][i] = phase['buckets'][i] + 1
+        entry = (timings.get("total", 0.0), path, size)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest_count > 0:
+            heapq.heappushpop(self.slowest, entry)
+
+    def summary(self):
+        phases = {}
+        for key in self.phases:
+            phase = self.phases[key]
+            phases[key] = {
+                'count': phase['count'],
+                'total': phase['total'],
+                'mean': phase['total'] / phase['count'],
+                'max': phase['max'],
+                'histogram': [{'le': bound, 'count': count} for bound, count in
+                              zip(self.bounds + [None], phase['buckets'])],
+            }
+        return {
+            'chunks': self.chunks,
+            'phases': phases,
+            'slowest': [{'path': path, 'size': size, 'total': total} for total, path, size
+                        in sorted(self.slowest, reverse=True)],
+        }
+
+    def print_summary(self):
+        print("")
+        print("Time per phase over {0} chunk(s):".format(self.chunks))
+        print("  {0:<28} {1:>10} {2:>10} {3:>10}".format("phase", "total s", "mean ms", "max ms"))
+        phases = sorted(self.phases.items(), key=lambda i: i[1]['total'], reverse=True)
+        for key, phase in phases:
+            print("  {0:<28} {1:>10.3f} {2:>10.3f} {3:>10.3f}".format(key, phase['total'],
+                    phase['total'] / phase['count'] * 1000, phase['max'] * 1000))
+        if self.slowest:
+            print("Slowest chunks:")
+            for total, path, size in sorted(self.slowest, reverse=True):
+                print("  {0:>8.3f} ms {1:>8} bytes {2}".format(total * 1000, size, path))
+
+class ValidationCache(object):
+    """Remembers the result of validating each chunk file so that chunks that
+    have not changed since the last run can be skipped. Entries are stored in
+    a SQLite database as (mtime, size, SHA-1 digest, results) keyed on the path
+    relative to the world, with the results stored as JSON. Results from a run
+    with different validator options are thrown away.
+    
+    get() is called from the thread that feeds jobs to the process pool while
+    put() is called from the main thread, so the connection is shared between
+    threads behind a lock."""
+    version = 5
+    batch_size = 1000
+
+    def __init__(self, path, options):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.lock = threading.Lock()
+        self.pending = []
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks "
+                          "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                          "digest TEXT, results TEXT)")
+        settings = repr((self.version, sorted(options.items())))
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        if row == None or row[0] != settings:
+            self.conn.execute("DROP TABLE chunks")
+            self.conn.execute("CREATE TABLE chunks "
+                              "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                              "digest TEXT, results TEXT)")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)",
+                              (settings,))
+        self.conn.commit()
+
+    def get(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT mtime, size, digest, results FROM chunks "
+                                    "WHERE path = ?", (path,)).fetchone()
+        if row == None:
+            return None
+        return row[0], row[1], row[2], json.loads(row[3])
+
+    def put(self, path, entry):
+        mtime, size, digest, results = entry
+        self.pending.append((path, mtime, size, digest, json.dumps(results)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                                  self.pending)
+            self.conn.commit()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+def iter_dir(path, want_dirs, match=None):
+    """Yields the names of the subdirectories (or files, if want_dirs is
+    False) in a directory as they are read, leaving out names that match
+    returns false for. Hidden entries are left out, the same as glob() does,
+    and unreadable directories are treated as empty.
+    
+    Without scandir, telling files from directories takes a stat, so only
+    directories are checked that way; files are picked by match alone, as
+    glob() would, to keep from statting every chunk."""
+    try:
+        if scandir != None:
+            for entry in scandir(path):
+                if entry.name[0] != "." and (match == None or match(entry.name)) \
+                        and entry.is_dir() == want_dirs:
+                    yield entry.name
+        else:
+            for name in os.listdir(path):
+                if name[0] == "." or (match != None and not match(name)):
+                    continue
+                if not want_dirs or os.path.isdir(os.path.join(path, name)):
+                    yield name
+    except OSError:
+        pass
+
+def is_region_name(name):
+    """Returns whether a file name looks like that of a region file."""
+    return name.startswith("r.") and name.endswith(".mcr")
+
+def is_chunk_name(name):
+    """Returns whether a file name looks like that of a chunk file."""
+    return name.startswith("c.") and name.endswith(".dat")
+
+class ChunkScanner(object):
+    """Walks a world's region/r.*.mcr region files and */*/c.*.dat chunk files
+    lazily so that validation can start before the whole world has been
+    listed. found is a running total of the files yielded so far and done is
+    set once the walk is complete.
+    
+    If a (index, count) shard is given, only region files and chunk
+    directories whose relative path hashes to index (modulo count) are
+    walked, so that several machines can split up one world."""
+    def __init__(self, world, shard=None):
+        self.world = world
+        self.shard = shard
+        self.found = 0
+        self.done = False
+    
+    def in_shard(self, rel_dir):
+        if self.shard == None:
+            return True
+        index, count = self.shard
+        return (zlib.crc32(rel_dir) & 0xffffffff) % count == index
+    
+    def __iter__(self):
+        region_dir = os.path.join(self.world, "region")
+        for name in iter_dir(region_dir, False, is_region_name):
+            if self.in_shard("region/" + name):
+                self.found = self.found + 1
+                yield os.path.join(region_dir, name)
+        for dir1 in iter_dir(self.world, True):
+            for dir2 in iter_dir(os.path.join(self.world, dir1), True):
+                if not self.in_shard(dir1 + "/" + dir2):
+                    continue
+                dir_path = os.path.join(self.world, dir1, dir2)
+                for name in iter_dir(dir_path, False, is_chunk_name):
+                    self.found = self.found + 1
+                    yield os.path.join(dir_path, name)
+        self.done = True
+
+def parse_shard(value):
+    """Parses a --shard value of the form i/N into an (i, N) tuple."""
+    try:
+        index, count = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, such as 0/4")
+    if count < 1 or index < 0 or index >= count:
+        raise argparse.ArgumentTypeError("expected 0 <= i < N")
+    return index, count
+
+class RegionValidator(object):
+    """Validates the chunks packed into a McRegion (.mcr) file. The file is
+    passed in as a buffer (normally an mmap) so that the header can be read
+    without copying it. Besides the chunks themselves, the location table is
+    checked for entries that overlap the header, run past the end of the file
+    or share sectors with another chunk."""
+    filename_match = re.compile(r"r\.(\-?\d+)\.(\-?\d+)\.mcr$")
+    location_fmt = Struct(">1024I")
+    chunk_header_fmt = Struct(">iB")
+    sector_size = 4096
+    compression_types = {1: "gzip", 2: "zlib"}
+
+    def __init__(self, path, data, options={}, timings=None):
+        self.path = path
+        self.data = data
+        self.options = options
+        self.timings = timings
+
+    def chunk_coords(self, index):
+        return self.region_x * 32 + (index & 31), self.region_z * 32 + (index >> 5)
+
+    def chunk_label(self, index):
+        return "{0}#{1},{2}".format(self.path, *self.chunk_coords(index))
+
+    def check_locations(self, locations):
+        """Returns a dict of chunk index to an error for every chunk whose
+        location table entry is bad."""
+        errors = {}
+        sectors = (len(self.data) + self.sector_size - 1) // self.sector_size
+        owners = {}
+        for index, location in enumerate(locations):
+            if location == 0:
+                continue
+            offset, count = location >> 8, location & 0xff
+            if offset < 2:
+                errors[index] = "Chunk sectors overlap the region header"
+            elif count == 0:
+                errors[index] = "Chunk has a sector count of 0"
+            elif offset + count > sectors:
+                errors[index] = "Chunk sectors lie outside of the region file"
+            else:
+                for sector in xrange(offset, offset + count):
+                    if sector in owners:
+                        other = owners[sector]
+                        errors[index] = "Chunk sectors overlap those of chunk {0},{1}".format(
+                                *self.chunk_coords(other))
+                        if other not in errors:
+                            errors[other] = "Chunk sectors overlap those of chunk {0},{1}".format(
+                                    *self.chunk_coords(index))
+                        break
+                    owners[sector] = index
+        return errors
+
+    def read_chunk(self, location):
+        """Returns the compression type and compressed data of a chunk."""
+        offset, count = location >> 8, location & 0xff
+        pos = offset * self.sector_size
+        if pos + self.chunk_header_fmt.size > len(self.data):
+            raise ValidationError("Chunk header lies outside of the region file")
+        length, compression = self.chunk_header_fmt.unpack_from(self.data, pos)
+        if length < 1 or length + 4 > count * self.sector_size:
+            raise ValidationError("Chunk length {0} does not fit in its {1} sector(s)"
+                    .format(length, count))
+        if compression not in self.compression_types:
+            raise ValidationError("Unknown chunk compression type {0}".format(compression))
+        return self.compression_types[compression], self.data[pos + 5:pos + 4 + length]
+
+    def validate_header(self):
+        """Reads the region coordinates and the location table. Returns an
+        error message if the file cannot be used at all, otherwise None."""
+        m = self.filename_match.search(self.path)
+        if not m:
+            return "Invalid region filename: " + self.path
+        self.region_x = int(m.group(1))
+        self.region_z = int(m.group(2))
+        if len(self.data) < self.sector_size * 2:
+            return "Region file is shorter than its header"
+        self.locations = self.location_fmt.unpack_from(self.data, 0)
+        return None
+
+    def validate(self):
+        """Returns a list of (label, errors, facts) tuples for every chunk in
+        the region, as returned by check_chunk(). Problems with the file as
+        a whole are reported with the path of the region as the label."""
+        error = self.validate_header()
+        if error != None:
+            return [(self.path, [error_details(ValidationError(error))], None)]
+        errors = self.check_locations(self.locations)
+        results = []
+        for index, location in enumerate(self.locations):
+            if location == 0:
+                continue
+            label = self.chunk_label(index)
+            if index in errors:
+                results.append((label, [error_details(ValidationError(errors[index]))], None))
+                continue
+            try:
+                compression, data = self.read_chunk(location)
+            except ValidationError, e:
+                results.append((label, [error_details(e)], None))
+                continue
+            results.append((label,) + check_chunk(label, data, self.options, self.timings,
+                                                  self.chunk_coords(index), compression))
+        return results
+
+def error_details(e):
+    """Returns the (error class, message, tag path) of an exception."""
+    return type(e).__name__, e.message or str(e), getattr(e, "tag_path", None)
+
+def check_chunk(path, data, options={}, timings=None, coords=None, compression="gzip"):
+    """Validates the raw contents of a chunk and returns an (errors, facts)
+    tuple. errors is a list of (error class, message, tag path) tuples for
+    the problems found, or None if the chunk is fine; unless the collect
+    option is set, there is at most one. facts are the chunk's facts for the
+    cross-chunk checks (see ChunkValidator.gather_facts()), or None if the
+    chunk could not be read."""
+    validator = None
+    try:
+        validator = ChunkValidator(path, coords=coords, compression=compression, **options)
+        validator.timings = timings
+        validator.validate(data)
+    except Exception, e:
+        errors = validator.errors if validator != None and validator.errors else []
+        facts = validator.facts if validator != None else None
+        return [error_details(error) for error in errors] + [error_details(e)], facts
+    if validator.errors:
+        return [error_details(error) for error in validator.errors], validator.facts
+    return None, validator.facts
+
+def split_region_label(label):
+    """Splits the label of a chunk inside a region file into the region
+    file's path and the chunk's (x, z) coordinates. Returns None for any
+    other label, including those of files in a path containing a #."""
+    path, sep, coords = label.rpartition("#")
+    if not sep or not path.endswith(".mcr"):
+        return None
+    try:
+        x, z = [int(v) for v in coords.split(",")]
+    except ValueError:
+        return None
+    return path, (x, z)
+
+def label_coords(label):
+    """Returns the chunk (x, z) coordinates of a result label, or None if
+    they cannot be told from the label."""
+    region_label = split_region_label(label)
+    if region_label != None: # A chunk inside a region file
+        return region_label[1]
+    m = ChunkValidator.filename_match.search(label)
+    if m:
+        try:
+            return int(m.group(1), 36), int(m.group(2), 36)
+        except ValueError:
+            pass
+    return None
+
+class CrossChunkChecker(object):
+    """Checks the world as a whole once every chunk has been validated, using
+    only the facts gathered about each chunk, so no chunk file is read again.
+    The chunks are kept in dicts keyed on (x, z) coordinates, which makes
+    each check a single pass over the chunks:
+    
+    - chunks whose xPos/zPos are stored in more than one place,
+    - missing chunks whose four neighbours all exist (holes in the explored
+      area) and
+    - tile entities that lie in another chunk than the one they are saved in."""
+    titles = {
+        'DuplicateChunk': "DUPLICATE CHUNK",
+        'MissingChunk': "MISSING CHUNK",
+        'MisplacedTileEntity': "MISPLACED TILE ENTITY",
+    }
+
+    def __init__(self, world):
+        self.world = world
+        self.files = {} # Coordinates of the file (or region slot) to its label
+        self.positions = {} # xPos/zPos stored in the chunk to its labels
+        self.elsewhere = [] # (label, coordinates) of misplaced tile entities
+
+    def name(self, label):
+        return os.path.relpath(label, self.world)
+
+    def add(self, label, facts):
+        coords = label_coords(label)
+        if coords != None:
+            self.files.setdefault(coords, label)
+        if facts == None:
+            return
+        x_pos, z_pos, elsewhere = facts
+        if x_pos != None and z_pos != None:
+            self.positions.setdefault((x_pos, z_pos), []).append(label)
+        for coords in elsewhere:
+            self.elsewhere.append((label, tuple(coords)))
+
+    def check(self):
+        """Returns a sorted list of (kind, (x, z), label, message) tuples for
+        the problems found."""
+        problems = []
+        for coords, labels in self.positions.iteritems():
+            if len(labels) > 1:
+                problems.append(('DuplicateChunk', coords, labels[0],
+                                 "Chunk {0},{1} is stored in {2} places: {3}".format(
+                                     coords[0], coords[1], len(labels),
+                                     ", ".join([self.name(label) for label in labels]))))
+        neighbours = {}
+        for x, z in self.files:
+            for coords in ((x - 1, z), (x + 1, z), (x, z - 1), (x, z + 1)):
+                if coords not in self.files:
+                    neighbours[coords] = neighbours.get(coords, 0) + 1
+        for coords, count in neighbours.iteritems():
+            if count == 4:
+                problems.append(('MissingChunk', coords, None,
+                                 "Chunk {0},{1} is missing but all of its neighbours "
+                                 "exist".format(*coords)))
+        for label, coords in self.elsewhere:
+            other = self.files.get(coords)
+            problems.append(('MisplacedTileEntity', coords, label,
+                             "{0} has a tile entity in chunk {1},{2}, which {3}".format(
+                                 self.name(label), coords[0], coords[1],
+                                 "is " + self.name(other) if other else "does not exist")))
+        problems.sort()
+        return problems
+
+def cache_results(path, results):
+    """Returns results with each label cut down to the part after the file's
+    path, so that a cache entry stays valid when the world is given by
+    another path or is copied somewhere else."""
+    return [[result[0][len(path):]] + list(result[1:]) for result in results]
+
+def cached_results(path, results):
+    """Turns results stored by cache_results() back into full labels for the
+    file at path."""
+    return [(path + result[0],) + tuple(result[1:]) for result in results]
+
+def validate_file(path, options={}, cached=None, profile=False):
+    """Validates a chunk (.dat) or region (.mcr) file and returns a (path,
+    results, entry, timings) tuple. results is a list of (label, errors,
+    facts) tuples for the chunks in the file, as returned by check_chunk();
+    for a chunk file, there is one entry labelled with its path. options are passed
+    on to ChunkValidator. If a cached (mtime, size, digest, results) entry is
+    given and the file has not changed, the cached results are returned instead
+    of validating again. entry is the up-to-date cache entry for the file (None
+    if the file could not be read), with its labels kept relative to the file
+    (see cache_results()). timings is a dict of the time spent in each
+    phase if profile is set and the file was validated, otherwise None. This
+    is a module-level function so that it can be handed to a multiprocessing
+    pool."""
+    start = time.time()
+    try:
+        st = os.stat(path)
+        if cached != None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return path, cached_results(path, cached[3]), cached, None
+        f = open(path, 'rb')
+        try:
+            if path.endswith(".mcr") and st.st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        finally:
+            f.close()
+    except Exception, e:
+        return path, [(path, [error_details(e)], None)], None, None
+    try:
+        read_time = time.time() - start
+        digest = hashlib.sha1(data).hexdigest()
+        if cached != None and cached[2] == digest: # Touched but not modified
+            return (path, cached_results(path, cached[3]),
+                    (st.st_mtime, st.st_size, digest, cached[3]), None)
+        timings = {'read': read_time} if profile else None
+        if path.endswith(".mcr"):
+            results = RegionValidator(path, data, options, timings).validate()
+        else:
+            results = [(path,) + check_chunk(path, data, options, timings)]
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    if profile:
+        timings['total'] = time.time() - start
+    entry = (st.st_mtime, st.st_size, digest, cache_results(path, results))
+    return path, results, entry, timings
+
+def validate_file_job(job, options={}, profile=False):
+    """Unpacks a (path, cached entry) job for validate_file()."""
+    return validate_file(job[0], options, job[1], profile)
+
+def strip_chunk(path, data, options={}, coords=None, compression="gzip"):
+    """Tries to fix a bad chunk by removing the entities and tile entities that
+    fail validation. Returns the fixed, uncompressed NBT and the number of
+    removed tags if the chunk validates afterwards, otherwise None."""
+    # Bad tags must raise to be removed, and the whole tree must be read as it
+    # is written back
+    options = dict(options, collect=False, lazy=False)
+    try:
+        validator = ChunkValidator(path, coords=coords, compression=compression, **options)
+        tags = list(validator.read_root_tags(data))
+    except Exception, e:
+        return None
+    if len(tags) != 1 or not isinstance(tags[0][1], CompoundTag):
+        return None
+    name, root = tags[0]
+    if 'Level' not in root or not isinstance(root['Level'], CompoundTag):
+        return None
+    level = root['Level']
+    removed = 0
+    for key, validate in (('Entities', validator.validate_entity),
+                          ('TileEntities', validator.validate_tile_entity)):
+        if key not in level or not isinstance(level[key], ListTag):
+            continue
+        kept = []
+        for child in level[key]:
+            try:
+                validate(child)
+                kept.append(child)
+            except Exception, e:
+                removed = removed + 1
+        level[key].data = kept
+    if removed == 0:
+        return None
+    try:
+        validator.validate_root_tags(tags)
+    except Exception, e:
+        return None
+    out = StringIO()
+    write_named_tag(out, name, root)
+    return out.getvalue(), removed
+
+class ProgressBar(object):
+    """Draws a single progress line on stderr, redrawn at most every interval
+    seconds so that printing does not slow down validation."""
+    interval = 0.5
+    width = 30
+
+    def __init__(self, out=sys.stderr):
+        self.out = out
+        self.last = 0
+        self.shown = False
+
+    def update(self, done, total, finished, corrupt, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        if finished and total > 0:
+            filled = self.width * done // total
+            bar = "[{0}{1}] {2}/{3}".format("#" * filled, "-" * (self.width - filled),
+                                            done, total)
+        else: # The total is not known yet
+            bar = "[{0}] {1}/{2}+".format("?" * self.width, done, total)
+        self.out.write("\r{0} files, {1} corrupt chunk(s)".format(bar, corrupt))
+        self.out.flush()
+        self.shown = True
+
+    def clear(self):
+        """Erases the progress line so that other output can be printed."""
+        if self.shown:
+            self.out.write("\r" + " " * (self.width + 60) + "\r")
+            self.out.flush()
+            self.shown = False
+        self.last = 0
+
+class ChunkRepairer(object):
+    """Takes the bad chunks found during a scan and deals with them in
+    batches. Loose chunk files are moved into the quarantine directory (under
+    the same relative path). With strip set, chunks that can be fixed by
+    removing bad entities and tile entities are rewritten in place instead,
+    with the original copied to the quarantine directory. Bad chunks inside
+    region files are dropped from (or rewritten into) the region, after a copy
+    of the whole region file has been put into quarantine."""
+    batch_size = 500
+
+    def __init__(self, world, quarantine, strip=False, options={}):
+        self.world = world
+        self.quarantine = quarantine
+        self.strip = strip
+        self.options = options
+        self.pending = []
+        self.backed_up = set()
+        self.quarantined = 0
+        self.repaired = 0
+        self.failed = 0
+
+    def add(self, label, errors):
+        self.pending.append(label)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        regions = {}
+        for label in self.pending:
+            region_label = split_region_label(label)
+            if not self.in_world(region_label[0] if region_label != None else label):
+                # Never move or rewrite files that belong to something else
+                self.failed = self.failed + 1
+                print("error: Not repairing {0}, which is outside of the world".format(label))
+            elif region_label != None:
+                path, coords = region_label
+                regions.setdefault(path, []).append(coords)
+            elif label.endswith(".mcr"): # The region file itself is broken
+                regions[label] = None
+            else:
+                self.repair_file(label)
+        for path in sorted(regions):
+            self.repair_region(path, regions[path])
+        self.pending = []
+
+    def in_world(self, path):
+        """Returns whether a path lies inside the world directory."""
+        rel_path = os.path.relpath(path, self.world)
+        return rel_path != os.pardir and not rel_path.startswith(os.pardir + os.sep)
+
+    def quarantine_path(self, path):
+        """Returns a free path in the quarantine directory for a file, so that
+        copies from earlier runs are never overwritten."""
+        dest = os.path.join(self.quarantine, os.path.relpath(path, self.world))
+        dir = os.path.dirname(dest)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        i = 1
+        base = dest
+        while os.path.exists(dest):
+            dest = "{0}.{1}".format(base, i)
+            i = i + 1
+        return dest
+
+    def report(self, action, label, removed=0):
+        rel_label = os.path.relpath(label, self.world)
+        if removed:
+            print("{0}: {1} (removed {2} bad entities/tile entities)".format(action, rel_label, removed))
+        else:
+            print("{0}: {1}".format(action, rel_label))
+
+    def repair_file(self, path):
+        try:
+            fixed = None
+            if self.strip:
+                f = open(path, "rb")
+                try:
+                    fixed = strip_chunk(path, f.read(), self.options)
+                finally:
+                    f.close()
+            dest = self.quarantine_path(path)
+            if fixed != None:
+                shutil.copy2(path, dest)
+                tmp_path = path + ".tmp"
+                f = open(tmp_path, "wb")
+                try:
+                    gz = gzip.GzipFile("", "wb", 9, f)
+                    gz.write(fixed[0])
+                    gz.close()
+                finally:
+                    f.close()
+                if os.name == "nt" and os.path.exists(path):
+                    os.remove(path) # rename() does not replace on Windows
+                os.rename(tmp_path, path)
+                self.repaired = self.repaired + 1
+                self.report("REPAIRED", path, fixed[1])
+            else:
+                shutil.move(path, dest)
+                self.quarantined = self.quarantined + 1
+                self.report("QUARANTINED", path)
+        except (IOError, OSError), e:
+            self.failed = self.failed + 1
+            print("error: Failed to repair {0}: {1}".format(path, e))
+
+    def repair_region(self, path, chunks):
+        """Drops or rewrites the given (x, z) chunks of a region file. If
+        chunks is None, the whole region file is quarantined."""
+        try:
+            if chunks == None:
+                shutil.move(path, self.quarantine_path(path))
+                self.quarantined = self.quarantined + 1
+                self.report("QUARANTINED", path)
+                return
+            if path not in self.backed_up:
+                shutil.copy2(path, self.quarantine_path(path))
+                self.backed_up.add(path)
+            f = open(path, "r+b")
+            try:
+                data = f.read()
+                region = RegionValidator(path, data)
+                if region.validate_header() != None:
+                    return
+                locations = list(region.locations)
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+                if end % region.sector_size != 0: # Pad the last sector
+                    f.write("\x00" * (region.sector_size - end % region.sector_size))
+                    end = f.tell()
+                for x, z in chunks:
+                    index = (x & 31) + (z & 31) * 32
+                    label = "{0}#{1},{2}".format(path, x, z)
+                    fixed = None
+                    if self.strip and locations[index] != 0:
+                        try:
+                            compression, chunk_data = region.read_chunk(locations[index])
+                            fixed = strip_chunk(label, chunk_data, self.options, (x, z),
+                                                compression)
+                        except ValidationError, e:
+                            pass
+                    if fixed != None:
+                        payload = zlib.compress(fixed[0])
+                        payload = IntTag.fmt.pack(len(payload) + 1) + "\x02" + payload
+                        count = (len(payload) + region.sector_size - 1) // region.sector_size
+                        f.write(payload.ljust(count * region.sector_size, "\x00"))
+                        locations[index] = (end // region.sector_size) << 8 | count
+                        end = end + count * region.sector_size
+                        self.repaired = self.repaired + 1
+                        self.report("REPAIRED", label, fixed[1])
+                    else:
+                        locations[index] = 0
+                        self.quarantined = self.quarantined + 1
+                        self.report("QUARANTINED", label)
+                f.seek(0)
+                f.write(region.location_fmt.pack(*locations))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            self.failed = self.failed + 1
+            print("error: Failed to repair {0}: {1}".format(path, e))
+
+def count_bytes(data):
+    """Returns a dict of byte value to the number of times it occurs in data.
+    str.count() runs in C, so this is one pass per distinct value."""
+    counts = {}
+    for c in set(data):
+        counts[ord(c)] = data.count(c)
+    return counts
+
+def count_ids(tags):
+    """Returns a dict of 'id' to count for a list of entities."""
+    counts = {}
+    for tag in tags:
+        if isinstance(tag, CompoundTag) and isinstance(tag.data.get('id'), StringTag):
+            id = tag.data['id'].data
+        else:
+            id = "?"
+        counts[id] = counts.get(id, 0) + 1
+    return counts
+
+def summarize_chunk(validator, data):
+    """Decodes a chunk and returns a dict summarizing its contents: the
+    number of each block ID, of each entity and tile entity type and its
+    LastUpdate. Raises an exception if the chunk cannot be read."""
+    tags = list(validator.read_root_tags(data))
+    if len(tags) != 1 or not isinstance(tags[0][1], CompoundTag):
+        raise ValidationError("Chunk does not have a single root compound tag")
+    level = tags[0][1].data.get('Level')
+    if not isinstance(level, CompoundTag):
+        raise ValidationError("Chunk has no Level compound tag")
+    level = level.data
+    summary = {'blocks': {}, 'entities': {}, 'tile_entities': {}, 'last_update': None}
+    if isinstance(level.get('Blocks'), ByteArrayTag):
+        summary['blocks'] = count_bytes(level['Blocks'].data)
+    if isinstance(level.get('Entities'), ListTag):
+        summary['entities'] = count_ids(level['Entities'].data)
+    if isinstance(level.get('TileEntities'), ListTag):
+        summary['tile_entities'] = count_ids(level['TileEntities'].data)
+    if isinstance(level.get('LastUpdate'), LongTag):
+        summary['last_update'] = level['LastUpdate'].data
+    return summary
+
+def summarize_file(path, options={}, cached=None):
+    """Summarizes every chunk in a chunk (.dat) or region (.mcr) file for the
+    world index and returns a (path, mtime, size, summaries, unreadable)
+    tuple. summaries is a list of (x, z, summary) tuples and unreadable is
+    the number of chunks that could not be decoded. If a cached (mtime, size)
+    is given and the file has not changed, summaries is None. This is a
+    module-level function so that it can be handed to a multiprocessing
+    pool."""
+    try:
+        st = os.stat(path)
+        if cached != None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return path, st.st_mtime, st.st_size, None, 0
+        f = open(path, 'rb')
+        try:
+            if path.endswith(".mcr") and st.st_size > 0:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError), e:
+        return path, None, None, [], 1
+    summaries = []
+    unreadable = 0
+    try:
+        if path.endswith(".mcr"):
+            region = RegionValidator(path, data, options)
+            if region.validate_header() != None:
+                return path, st.st_mtime, st.st_size, [], 1
+            errors = region.check_locations(region.locations)
+            for index, location in enumerate(region.locations):
+                if location == 0:
+                    continue
+                x, z = region.chunk_coords(index)
+                try:
+                    if index in errors:
+                        raise ValidationError(errors[index])
+                    compression, chunk = region.read_chunk(location)
+                    validator = ChunkValidator(path, coords=(x, z),
+                                               compression=compression, **options)
+                    summaries.append((x, z, summarize_chunk(validator, chunk)))
+                except Exception, e:
+                    unreadable = unreadable + 1
+        else:
+            try:
+                validator = ChunkValidator(path, **options)
+                summaries.append((validator.expected_x, validator.expected_z,
+                                  summarize_chunk(validator, data)))
+            except Exception, e:
+                unreadable = unreadable + 1
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return path, st.st_mtime, st.st_size, summaries, unreadable
+
+def summarize_file_job(job, options={}):
+    """Unpacks a (path, cached entry) job for summarize_file()."""
+    return summarize_file(job[0], options, job[1])
+
+class WorldIndex(object):
+    """An on-disk index of per-chunk summaries, keyed on chunk coordinates,
+    kept in a SQLite database. Files are only summarized again when their
+    mtime or size change, and statistics are answered from the index alone.
+    
+    Like ValidationCache, get() is called from the thread that feeds the
+    process pool, so the connection is shared behind a lock."""
+    version = 1
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row == None or row[0] != str(self.version):
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute("DROP TABLE IF EXISTS chunks")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                              (str(self.version),))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files "
+                          "(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                          "unreadable INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks "
+                          "(x INTEGER, z INTEGER, path TEXT, last_update INTEGER, "
+                          "entities INTEGER, tile_entities INTEGER, summary TEXT, "
+                          "PRIMARY KEY (x, z))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path)")
+        self.conn.commit()
+
+    def get(self, path):
+        with self.lock:
+            return self.conn.execute("SELECT mtime, size FROM files WHERE path = ?",
+                                     (path,)).fetchone()
+
+    def put(self, path, mtime, size, summaries, unreadable):
+        """Replaces the chunks indexed for a file."""
+        with self.lock:
+            self.conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+            self.conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(x, z, path, summary['last_update'],
+                                    sum(summary['entities'].values()),
+                                    sum(summary['tile_entities'].values()),
+                                    json.dumps(summary)) for x, z, summary in summaries])
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                              (path, mtime, size, unreadable))
+            self.pending = self.pending + 1
+            if self.pending >= self.batch_size:
+                self.conn.commit()
+                self.pending = 0
+
+    def prune(self, seen):
+        """Drops the files (and their chunks) that are not in seen."""
+        with self.lock:
+            gone = [row[0] for row in self.conn.execute("SELECT path FROM files")
+                    if row[0] not in seen]
+            for path in gone:
+                self.conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+                self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        return len(gone)
+
+    def stats(self):
+        """Reduces the whole index into a WorldStats."""
+        stats = WorldStats()
+        with self.lock:
+            for row in self.conn.execute("SELECT SUM(unreadable) FROM files"):
+                stats.unreadable = row[0] or 0
+            for x, z, summary in self.conn.execute("SELECT x, z, summary FROM chunks"):
+                stats.add(x, z, json.loads(summary))
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class WorldStats(object):
+    """World-wide counts reduced from chunk summaries."""
+    top = 10 # Number of chunks with the most entities to list
+    buckets = 10 # Number of LastUpdate histogram buckets
+
+    def __init__(self):
+        self.chunks = 0
+        self.unreadable = 0
+        self.blocks = {}
+        self.entities = {}
+        self.tile_entities = {}
+        self.entity_counts = {}
+        self.busiest = [] # Heap of (entities, x, z)
+        self.last_updates = []
+
+    def add(self, x, z, summary):
+        self.chunks = self.chunks + 1
+        for id, count in summary['blocks'].iteritems():
+            id = int(id) # JSON turns the keys into strings
+            self.blocks[id] = self.blocks.get(id, 0) + count
+        for key, counts in (('entities', self.entities),
+                            ('tile_entities', self.tile_entities)):
+            for id, count in summary[key].iteritems():
+                counts[id] = counts.get(id, 0) + count
+        entities = sum(summary['entities'].values())
+        bucket = 0 if entities == 0 else 10 ** len(str(entities)) # Upper bound
+        self.entity_counts[bucket] = self.entity_counts.get(bucket, 0) + 1
+        if len(self.busiest) < self.top:
+            heapq.heappush(self.busiest, (entities, x, z))
+        elif entities > self.busiest[0][0]:
+            heapq.heapreplace(self.busiest, (entities, x, z))
+        if summary['last_update'] != None:
+            self.last_updates.append(summary['last_update'])
+
+    def last_update_histogram(self):
+        """Returns a list of (first, last, chunks) buckets of LastUpdate."""
+        if not self.last_updates:
+            return []
+        low, high = min(self.last_updates), max(self.last_updates)
+        width = max(1, (high - low + self.buckets) // self.buckets)
+        counts = [0] * self.buckets
+        for value in self.last_updates:
+            counts[min((value - low) // width, self.buckets - 1)] += 1
+        return [(low + i * width, min(high, low + (i + 1) * width - 1), count)
+                for i, count in enumerate(counts)]
+
+    def summary(self):
+        return {
+            'chunks': self.chunks,
+            'unreadable': self.unreadable,
+            'blocks': dict([(str(k), v) for k, v in self.blocks.items()]),
+            'entities': self.entities,
+            'tile_entities': self.tile_entities,
+            'entities_per_chunk': dict([(str(k), v) for k, v in self.entity_counts.items()]),
+            'most_entities': [{'x': x, 'z': z, 'entities': n}
+                              for n, x, z in sorted(self.busiest, reverse=True)],
+            'last_update': [{'first': first, 'last': last, 'chunks': count}
+                            for first, last, count in self.last_update_histogram()],
+        }
+
+    def print_summary(self):
+        print("")
+        print("Indexed {0} chunk(s); {1} could not be read.".format(self.chunks, self.unreadable))
+        print("")
+        print("Blocks:")
+        for id, count in sorted(self.blocks.items()):
+            print("  {0:>5} {1:>14}".format(id, count))
+        for title, counts in (("Entities:", self.entities),
+                              ("Tile entities:", self.tile_entities)):
+            print("")
+            print(title)
+            for id, count in sorted(counts.items(), key=lambda i: (-i[1], i[0])):
+                print("  {0:<20} {1:>10}".format(id, count))
+        print("")
+        print("Entities per chunk:")
+        for bucket in sorted(self.entity_counts):
+            label = "0" if bucket == 0 else "< {0}".format(bucket)
+            print("  {0:<10} {1:>10} chunk(s)".format(label, self.entity_counts[bucket]))
+        print("")
+        print("Chunks with the most entities:")
+        for n, x, z in sorted(self.busiest, reverse=True):
+            print("  {0:>8} {1},{2}".format(n, x, z))
+        print("")
+        print("LastUpdate:")
+        for first, last, count in self.last_update_histogram():
+            print("  {0:>12} - {1:<12} {2:>10} chunk(s)".format(first, last, count))
+
+def build_index(world, index, files, options={}, jobs=1, full=False):
+    """Summarizes the chunks of the given files into the index. Files are
+    summarized by a process pool (the map), and the summaries are stored as
+    they come back, to be reduced by WorldIndex.stats(). Returns the set of
+    files seen, relative to the world, and the number that had to be
+    summarized again."""
+    if full:
+        jobs_iter = ((path, None) for path in files)
+    else:
+        jobs_iter = ((path, index.get(os.path.relpath(path, world))) for path in files)
+    summarize = functools.partial(summarize_file_job, options=options)
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(summarize, jobs_iter, chunksize=16)
+    else:
+        results = itertools.imap(summarize, jobs_iter)
+    seen = set()
+    updated = 0
+    for path, mtime, size, summaries, unreadable in results:
+        rel_path = os.path.relpath(path, world)
+        seen.add(rel_path)
+        if summaries == None:
+            continue
+        index.put(rel_path, mtime, size, summaries, unreadable)
+        updated = updated + 1
+    if pool != None:
+        pool.close()
+        pool.join()
+    return seen, updated
+
+def write_bad_chunk(f, label, errors):
+    """Writes a bad chunk to a --write-bad-chunks report: the chunk's label
+    followed by a comment line for each error."""
+    f.write(label + "\r\n")
+    for error_class, error, tag_path in errors:
+        f.write("# " + error.replace("\r", "").replace("\n", "") + "\r\n")
+
+def is_world_file(name):
+    """Returns whether a file name is that of a chunk or region file."""
+    return bool(ChunkValidator.filename_match.search(name) or
+                RegionValidator.filename_match.search(name))
+
+class InotifyWatcher(object):
+    """Reports the chunk and region files written in a world, using Linux's
+    inotify through ctypes. inotify is not recursive, so the world, its
+    region directory and the two levels of chunk directories are watched one
+    by one, and new directories are watched as they are created."""
+    event_fmt = Struct("iIII")
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    description = "inotify"
+
+    def __init__(self, world):
+        if ctypes == None or not sys.platform.startswith("linux"):
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify")
+        self.world = world
+        self.dirs = {} # Watch descriptor to (directory, depth below the world)
+        self.overflowed = False
+        self.add_tree(world, 0)
+
+    def add_watch(self, path, depth):
+        wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Could not watch " + path)
+        self.dirs[wd] = (path, depth)
+
+    def add_tree(self, path, depth):
+        """Watches a directory and the directories below it that can hold
+        chunks. Returns the chunk files already in them, which may have been
+        written before the watch was in place."""
+        self.add_watch(path, depth)
+        files = []
+        if depth < 2 and not (depth == 1 and os.path.basename(path) == "region"):
+            for name in iter_dir(path, True):
+                files.extend(self.add_tree(os.path.join(path, name), depth + 1))
+        for name in iter_dir(path, False, is_world_file):
+            files.append(os.path.join(path, name))
+        return files
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds and returns the files written."""
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error:
+            return []
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        files = []
+        pos = 0
+        while pos + self.event_fmt.size <= len(data):
+            wd, mask, cookie, size = self.event_fmt.unpack_from(data, pos)
+            name = data[pos + self.event_fmt.size:pos + self.event_fmt.size + size].rstrip("\x00")
+            pos = pos + self.event_fmt.size + size
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if wd not in self.dirs:
+                continue
+            dir, depth = self.dirs[wd]
+            path = os.path.join(dir, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and depth < 2:
+                    try:
+                        files.extend(self.add_tree(path, depth + 1))
+                    except OSError:
+                        pass
+            elif is_world_file(name):
+                files.append(path)
+        return files
+
+class PollingWatcher(object):
+    """Reports the chunk and region files written in a world by walking it
+    every interval seconds and comparing the mtime and size of each file."""
+    def __init__(self, world, interval):
+        self.world = world
+        self.interval = interval
+        self.description = "polling every {0} s".format(interval)
+        self.files = self.scan()
+        self.next_scan = time.time() + interval
+
+    def scan(self):
+        files = {}
+        for path in ChunkScanner(self.world):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (st.st_mtime, st.st_size)
+        return files
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds and returns the files written."""
+        delay = self.next_scan - time.time()
+        if delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+        files = self.scan()
+        changed = [path for path, stat in files.iteritems() if self.files.get(path) != stat]
+        self.files = files
+        self.next_scan = time.time() + self.interval
+        return changed
+
+def ignore_sigint():
+    """Pool initializer that leaves Ctrl-C to the parent process, which
+    stops the workers itself."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watch_world(world, watcher, options={}, jobs=1, delay=5.0, bad_chunk_f=None):
+    """Validates chunk and region files again once they have not been written
+    to for delay seconds, on a pool of jobs processes, until interrupted. Bad
+    chunks are printed and appended to bad_chunk_f; a chunk is only reported
+    again if its errors change."""
+    pool = multiprocessing.Pool(jobs, ignore_sigint)
+    pending = {} # Path to the time it is due to be validated
+    running = []
+    reported = {} # Label to the errors last reported for it
+    try:
+        while True:
+            now = time.time()
+            for path in [path for path, due in pending.iteritems() if due <= now]:
+                del pending[path]
+                running.append(pool.apply_async(validate_file, (path, options)))
+            timeout = 1.0
+            if running:
+                timeout = 0.2
+            if pending:
+                timeout = max(0, min(timeout, min(pending.values()) - now))
+            for path in watcher.wait(timeout):
+                # Every write pushes the deadline back, so a file that is
+                # being written to is validated once it settles
+                pending[path] = time.time() + delay
+            for result in [result for result in running if result.ready()]:
+                running.remove(result)
+                path, chunk_results, entry, timings = result.get()
+                print("[{0}] {1}".format(time.strftime("%H:%M:%S"),
+                                         os.path.relpath(path, world)))
+                for label, errors, facts in chunk_results:
+                    if errors == None:
+                        if label in reported:
+                            del reported[label]
+                            print("FIXED CHUNK {0}".format(os.path.relpath(label, world)))
+                        continue
+                    errors = [tuple(error) for error in errors]
+                    if reported.get(label) == errors:
+                        continue
+                    reported[label] = errors
+                    for error_class, error, tag_path in errors:
+                        print("BAD CHUNK {0}: {1}".format(os.path.relpath(label, world), error))
+                    if bad_chunk_f != None:
+                        try:
+                            write_bad_chunk(bad_chunk_f, label, errors)
+                            bad_chunk_f.flush()
+                        except IOError, e:
+                            print("error: Failed to write bad chunk output file")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
 
 def main():
     epilog = """
 checkworld.py does a deep strict validation of the world files of a Minecraft
 Alpha/Beta server. It is designed to be run on world files that have not
-had additional entity types added (through mods). Currently the program does
-not perform a deep check on entities, although it does check for acceptable
-entity types. For all other cases, checkworld.py does a very strict and
-deep check, down to acceptable item and block IDs. Only chunk files are checked."""
+had additional entity types added (through mods), unless those are described
+in a JSON ID profile given with --ids. Entities are checked for their
+position, motion and rotation and dropped items for their item stack, but
+mob-specific fields are not checked. For all other cases, checkworld.py does
+a very strict and deep check, down to acceptable item and block IDs. Only chunk files (loose
+c.*.dat files and chunks in McRegion .mcr files) are checked."""
 
     parser = argparse.ArgumentParser(prog='checkworld.py',
                                      description='Checks a Minecraft Alpha/Beta world',
@@ -402,62 +2215,344 @@ deep check, down to acceptable item and block IDs. Only chunk files are checked.
                         help='world directory')
     parser.add_argument('--write-bad-chunks', dest='write_bad', metavar='filename', type=str,
                         help='write bad chunks to a file, optionally specifying a filename')
+    parser.add_argument('--jobs', '-j', dest='jobs', metavar='N', type=int,
+                        default=1,
+                        help='number of processes to validate chunks with')
+    parser.add_argument('--lazy', dest='lazy', action='store_true',
+                        help='decode chunks lazily, skipping unneeded data')
+    parser.add_argument('--engine', dest='engine', type=str,
+                        choices=['stream', 'fast'], default='stream',
+                        help='NBT decoder to use (defaults to stream)')
+    parser.add_argument('--max-chunk-size', dest='max_size', metavar='MB', type=int,
+                        default=DEFAULT_MAX_CHUNK_SIZE // (1024 * 1024),
+                        help='reject chunks that decompress to more than this many '
+                             'megabytes (defaults to {0})'.format(
+                                 DEFAULT_MAX_CHUNK_SIZE // (1024 * 1024)))
+    parser.add_argument('--deep', dest='deep', action='store_true',
+                        help='also check Data, SkyLight and HeightMap against the blocks')
+    parser.add_argument('--all-errors', dest='collect', action='store_true',
+                        help='report every problem in a chunk instead of just the first')
+    parser.add_argument('--json-lines', dest='json_lines', metavar='filename', type=str,
+                        help='write each problem found as a line of JSON to a file '
+                             '(- for standard output, moving the other output to '
+                             'standard error)')
+    parser.add_argument('--progress', dest='progress', type=str,
+                        choices=['lines', 'bar', 'none'], default='lines',
+                        help='how to show progress: a line per file, a progress bar '
+                             'or nothing (defaults to lines)')
+    parser.add_argument('--max-entities', dest='max_entities', metavar='N', type=int,
+                        default=DEFAULT_MAX_ENTITIES,
+                        help='report chunks with more than N entities, which lag the server '
+                             '(defaults to {0}; 0 to disable)'.format(DEFAULT_MAX_ENTITIES))
+    parser.add_argument('--ids', dest='id_profile', metavar='profile', type=str,
+                        default=DEFAULT_ID_PROFILE,
+                        help='valid IDs to check against: one of {0} or a JSON profile file '
+                             '(defaults to {1})'.format(", ".join(sorted(id_profiles)),
+                                                        DEFAULT_ID_PROFILE))
+    parser.add_argument('--cache', dest='cache', metavar='filename', type=str,
+                        help='validation cache file (defaults to checkworld.db in the world)')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='do not read or update the validation cache')
+    parser.add_argument('--full', dest='full', action='store_true',
+                        help='validate every chunk, even ones unchanged since the last run')
+    parser.add_argument('--shard', dest='shard', metavar='i/N', type=parse_shard,
+                        help='only check shard i (counting from 0) of N of the world')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='time each phase and validator and print a summary')
+    parser.add_argument('--stats-json', dest='stats_json', metavar='filename', type=str,
+                        help='write timing statistics (world statistics for index and '
+                             'stats) to a JSON file (implies --profile)')
+    parser.add_argument('--slowest', dest='slowest', metavar='N', type=int, default=10,
+                        help='number of slowest chunks to list when profiling (default 10)')
+    parser.add_argument('--quarantine', dest='quarantine', metavar='dir', type=str,
+                        help='where repair puts bad chunks (defaults to checkworld-quarantine in the world)')
+    parser.add_argument('--strip', dest='strip', action='store_true',
+                        help='have repair remove bad entities/tile entities instead of '
+                             'quarantining the whole chunk when that fixes it')
+    parser.add_argument('--index', dest='index', metavar='filename', type=str,
+                        help='world index file for index and stats (defaults to '
+                             'checkworld-index.db in the world)')
+    parser.add_argument('--cross-check', dest='cross_check', action='store_true',
+                        help='after validating, check the chunks against each other for '
+                             'duplicates, holes and misplaced tile entities')
+    parser.add_argument('--delay', dest='delay', metavar='seconds', type=float, default=5.0,
+                        help='for watch, how long a file must go unwritten before it is '
+                             'validated again (default 5)')
+    parser.add_argument('--poll', dest='poll', metavar='seconds', type=float,
+                        help='for watch, poll the world at this interval instead of '
+                             'using inotify')
     parser.add_argument('action', metavar='action', type=str,
-                        choices=['validate'],
+                        choices=['validate', 'repair', 'index', 'stats', 'watch'],
                         help='an action to perform')
 
     args = parser.parse_args()
     world = args.world
     action = args.action
     write_bad_chunks = args.write_bad
+    jobs = args.jobs
+    validator_options = {'lazy': args.lazy, 'engine': args.engine,
+                         'id_profile': args.id_profile, 'collect': args.collect,
+                         'max_entities': args.max_entities, 'deep': args.deep,
+                         'max_size': args.max_size * 1024 * 1024}
+    
+    if jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.cross_check and args.shard != None:
+        parser.error("--cross-check needs the whole world and cannot be used with --shard")
+    if args.delay < 0:
+        parser.error("--delay cannot be negative")
+    if args.poll != None and args.poll <= 0:
+        parser.error("--poll must be more than 0")
+    if args.max_size < 1:
+        parser.error("--max-chunk-size must be at least 1")
+    if args.max_entities < 0:
+        parser.error("--max-entities cannot be negative")
+    
+    try:
+        ChunkValidator.compile(args.id_profile)
+    except CheckerException, e:
+        parser.error(e.message)
+    
+    json_f = None
+    if args.json_lines == '-':
+        # The JSON lines get stdout to themselves, so everything else that
+        # would be printed goes to stderr instead
+        json_f = sys.stdout
+        sys.stdout = sys.stderr
     
     print("checkworld.py - Minecraft Alpha/Beta world checker")
     print("Copyright (c) 2010, 2011 sk89q <http://www.sk89q.com>")
     print("")
     
-    print("Looking for chunk files...")
-    files = glob(os.path.join(world, "*/*/c.*.dat"))
-    total = len(files)
-    
-    if total == 0:
-        print("error: Failed to find chunk files")
+    if not os.path.isdir(world):
+        print("error: World directory does not exist")
         sys.exit(1)
     
+    if action in ('index', 'stats'):
+        index_path = args.index or os.path.join(world, "checkworld-index.db")
+        if action == 'stats' and not os.path.exists(index_path):
+            print("error: The world has not been indexed yet")
+            sys.exit(1)
+        try:
+            index = WorldIndex(index_path)
+            if action == 'index':
+                print("Looking for chunk files and indexing...")
+                seen, updated = build_index(world, index, ChunkScanner(world, args.shard),
+                                            validator_options, jobs, args.full)
+                if args.shard == None:
+                    index.prune(seen)
+                print("Indexed {0} of {1} file(s); the rest were unchanged.".format(
+                        updated, len(seen)))
+            stats = index.stats()
+            index.close()
+        except sqlite3.Error, e:
+            print("error: Could not use the world index: {0}".format(e))
+            sys.exit(2)
+        stats.print_summary()
+        if args.stats_json:
+            try:
+                f = open(args.stats_json, "wb")
+                try:
+                    json.dump(stats.summary(), f, indent=2, sort_keys=True)
+                finally:
+                    f.close()
+            except IOError, e:
+                print("error: Failed to write statistics file")
+        return
+    
+    repairer = None
+    if action == 'repair':
+        quarantine = args.quarantine or os.path.join(world, "checkworld-quarantine")
+        repairer = ChunkRepairer(world, quarantine, args.strip, validator_options)
+    
     bad_chunk_f = None
     if write_bad_chunks != None:
         try:
-            bad_chunk_f = open(write_bad_chunks, "wb")
+            # Watching adds to the report of an earlier run
+            bad_chunk_f = open(write_bad_chunks, "ab" if action == 'watch' else "wb")
         except IOError, e:
             print("error: Could not open bad chunks output file")
             sys.exit(2)
     
-    print("Found {0} chunk files; now validating...".format(total))
+    if action == 'watch':
+        watcher = None
+        if args.poll == None:
+            try:
+                watcher = InotifyWatcher(world)
+            except OSError, e:
+                print("warning: Could not use inotify ({0}); polling instead".format(e))
+        if watcher == None:
+            watcher = PollingWatcher(world, args.poll or 10.0)
+        print("Watching for changes ({0})...".format(watcher.description))
+        sys.stdout.flush()
+        watch_world(world, watcher, validator_options, jobs, args.delay, bad_chunk_f)
+        if bad_chunk_f != None:
+            try:
+                bad_chunk_f.close()
+            except IOError: pass
+        return
+    
+    if args.json_lines not in (None, '-'):
+        try:
+            json_f = open(args.json_lines, "wb")
+        except IOError, e:
+            print("error: Could not open JSON lines output file")
+            sys.exit(2)
+    
+    cache = None
+    if not args.no_cache:
+        cache_path = args.cache or os.path.join(world, "checkworld.db")
+        try:
+            cache = ValidationCache(cache_path, validator_options)
+        except sqlite3.Error, e:
+            print("warning: Could not open validation cache; validating everything")
+    
+    print("Looking for chunk files and validating...")
+    
+    files = ChunkScanner(world, args.shard)
+    if cache != None and not args.full:
+        jobs_iter = ((path, cache.get(os.path.relpath(path, world))) for path in files)
+    else:
+        jobs_iter = ((path, None) for path in files)
+    
+    profile = None
+    if args.profile or args.stats_json:
+        profile = RunProfile(args.slowest)
+    
+    validate = functools.partial(validate_file_job, options=validator_options,
+                                 profile=profile != None)
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        # imap() keeps results in the same order as the input, so the output
+        # is identical to a serial run
+        results = pool.imap(validate, jobs_iter, chunksize=16)
+    else:
+        results = itertools.imap(validate, jobs_iter)
+    
+    progress = ProgressBar() if args.progress == 'bar' else None
+    cross = CrossChunkChecker(world) if args.cross_check else None
     
     i = 0
+    chunks = 0
     corrupt = 0
-    for path in files:
-        progress = i / float(total)
+    for path, chunk_results, entry, timings in results:
+        if cache != None and entry != None:
+            cache.put(os.path.relpath(path, world), entry)
+        if profile != None and timings != None:
+            profile.add(path, entry[1], timings)
+        # The scanner may still be looking for more files
+        total = str(files.found) + ("" if files.done else "+")
         rel_path = os.path.relpath(path, world)
-        print("[{0}/{1} {2}% {3}] {4}".format(i + 1, total, int(progress * 100), corrupt, rel_path))
-        try:
-            ChunkValidator(path).validate()
-        except Exception, e:
+        if args.progress == 'lines':
+            print("[{0}/{1} {2}] {3}".format(i + 1, total, corrupt, rel_path))
+        for label, errors, facts in chunk_results:
+            chunks = chunks + 1
+            if cross != None:
+                cross.add(label, facts)
+            if errors == None:
+                continue
             corrupt = corrupt + 1
-            print("BAD CHUNK: " + e.message)
+            if progress != None:
+                progress.clear()
+            rel_label = os.path.relpath(label, world)
+            for error_class, error, tag_path in errors:
+                if label == path:
+                    print("BAD CHUNK: " + error)
+                else: # A chunk inside a region file
+                    print("BAD CHUNK {0}: {1}".format(rel_label, error))
             if bad_chunk_f != None:
                 try:
-                    bad_chunk_f.write(path + "\r\n")
-                    bad_chunk_f.write("# " + e.message.replace("\r", "").replace("\n", "") + "\r\n")
+                    write_bad_chunk(bad_chunk_f, label, errors)
                 except IOError, e:
                     print("error: Failed to write bad chunk output file")
+            if json_f != None:
+                coords = label_coords(label)
+                try:
+                    for error_class, error, tag_path in errors:
+                        json_f.write(json.dumps({
+                            'path': rel_label,
+                            'x': coords[0] if coords else None,
+                            'z': coords[1] if coords else None,
+                            'class': error_class,
+                            'message': error,
+                            'tag': tag_path,
+                        }, sort_keys=True) + "\n")
+                except IOError, e:
+                    print("error: Failed to write JSON lines output file")
+            if repairer != None:
+                repairer.add(label, errors)
         i = i + 1
+        if progress != None:
+            progress.update(i, files.found, files.done, corrupt)
+    
+    if progress != None:
+        progress.update(i, files.found, files.done, corrupt, force=True)
+        progress.clear()
+    
+    if pool != None:
+        pool.close()
+        pool.join()
+    
+    problems = []
+    if cross != None:
+        problems = cross.check()
+        for kind, coords, label, message in problems:
+            print("{0}: {1}".format(cross.titles[kind], message))
+            if json_f != None:
+                try:
+                    json_f.write(json.dumps({
+                        'path': os.path.relpath(label, world) if label else None,
+                        'x': coords[0],
+                        'z': coords[1],
+                        'class': kind,
+                        'message': message,
+                        'tag': None,
+                    }, sort_keys=True) + "\n")
+                except IOError, e:
+                    print("error: Failed to write JSON lines output file")
+    
+    if repairer != None:
+        repairer.flush()
+    
+    if cache != None:
+        try:
+            cache.close()
+        except sqlite3.Error, e:
+            print("warning: Failed to save validation cache")
     
     if bad_chunk_f != None:
         try:
             bad_chunk_f.close()
         except IOError: pass
     
-    print("Scanned with {0} corrupt chunk(s) detected.".format(corrupt))
+    if json_f != None and args.json_lines != '-':
+        try:
+            json_f.close()
+        except IOError: pass
+    
+    if i == 0:
+        print("error: Failed to find chunk files")
+        sys.exit(1)
+    
+    print("Scanned {0} chunk(s) with {1} corrupt chunk(s) detected.".format(chunks, corrupt))
+    if cross != None:
+        print("Found {0} problem(s) across chunks.".format(len(problems)))
+    if repairer != None:
+        print("Repaired {0}, quarantined {1} and failed to handle {2} chunk(s).".format(
+                repairer.repaired, repairer.quarantined, repairer.failed))
+    
+    if profile != None:
+        profile.print_summary()
+        if args.stats_json:
+            try:
+                f = open(args.stats_json, "wb")
+                try:
+                    json.dump(profile.summary(), f, indent=2, sort_keys=True)
+                finally:
+                    f.close()
+            except IOError, e:
+                print("error: Failed to write statistics file")
 
 if __name__ == "__main__":
     main()
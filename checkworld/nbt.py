@@ -0,0 +1,451 @@
+#!/usr/bin/env python2.7
+#
+# nbt.py - Reading and writing of Minecraft NBT data
+# Copyright (c) 2010, 2011 sk89q <http://www.sk89q.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id#
+
+"""Reads and writes NBT, the tag format of Minecraft's chunks and level
+files. Tags are small __slots__ objects that hold their value in data and
+nothing else: a tag does not know its name or its parent, so a tree of tags
+has no cycles and costs little memory. Names are the keys of a compound
+tag's dict (or the position in a list), and code that needs the path of a
+tag keeps the names on a stack while walking the tree.
+
+    tags = nbt.load("c.0.0.dat")          # [(name, tag), ...]
+    level = tags[0][1]["Level"]
+    nbt.dump("c.0.0.dat", tags)
+"""
+
+import gzip
+from struct import Struct
+from cStringIO import StringIO
+
+class NBTError(Exception): pass
+class FormatParseException(NBTError): pass
+class UnknownTagTypeError(FormatParseException): pass
+class DuplicateNamedTagError(FormatParseException): pass
+
+class BufferReader(object):
+    """Reads tags out of an already decompressed string. Unlike a file
+    reader, it can skip over data without copying it, and with lazy set,
+    byte arrays only remember where their payload is instead of copying it
+    out until somebody actually looks at the data."""
+    def __init__(self, buf, lazy=False):
+        self.buf = buf
+        self.pos = 0
+        self.lazy = lazy
+    def read(self, size):
+        data = self.buf[self.pos:self.pos + size]
+        self.pos = self.pos + len(data)
+        return data
+    def skip(self, size):
+        if size < 0: # Would move back and could read the same tags forever
+            raise FormatParseException("Negative tag size: {0}".format(size))
+        self.pos = min(self.pos + size, len(self.buf))
+    def tell(self):
+        return self.pos
+
+class BaseTag(object):
+    __slots__ = ('data',)
+    unnamed = False
+    def __init__(self, data):
+        self.data = data
+    def __repr__(self):
+        return repr(self.data)
+    @classmethod
+    def read(cls, reader, schema=None):
+        return cls(cls.fmt.unpack(reader.read(cls.fmt.size))[0])
+    @classmethod
+    def skip(cls, reader):
+        reader.skip(cls.fmt.size)
+    def write(self, out):
+        out.write(self.fmt.pack(self.data))
+
+class EndTag(BaseTag):
+    __slots__ = ()
+    unnamed = True
+    def __init__(self):
+        self.data = None
+
+class ByteTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">b")
+
+class ShortTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">h")
+
+class IntTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">i")
+
+class LongTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">q")
+
+class FloatTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">f")
+
+class DoubleTag(BaseTag):
+    __slots__ = ()
+    fmt = Struct(">d")
+
+class ByteArrayTag(BaseTag):
+    __slots__ = ()
+    def __len__(self):
+        return len(self.data)
+    def __repr__(self):
+        return "<{0} bytes>".format(len(self))
+    @classmethod
+    def read(cls, reader, schema=None):
+        size = IntTag.read(reader).data
+        if size < 0:
+            raise FormatParseException("Negative byte array size: {0}".format(size))
+        if getattr(reader, "lazy", False):
+            offset = reader.tell()
+            reader.skip(size)
+            return LazyByteArrayTag(reader.buf, offset, reader.tell() - offset)
+        return ByteArrayTag(reader.read(size))
+    @classmethod
+    def skip(cls, reader):
+        reader.skip(IntTag.read(reader).data)
+    def write(self, out):
+        out.write(IntTag.fmt.pack(len(self)))
+        out.write(self.data)
+
+class LazyByteArrayTag(ByteArrayTag):
+    """A byte array that only knows the offset and length of its payload in
+    the decompressed data. The payload is sliced out on first access."""
+    __slots__ = ('buf', 'offset', 'size', '_data')
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.offset = offset
+        self.size = size
+        self._data = None
+    def __len__(self):
+        return self.size
+    @property
+    def data(self):
+        if self._data == None:
+            self._data = self.buf[self.offset:self.offset + self.size]
+        return self._data
+
+class StringTag(BaseTag):
+    __slots__ = ()
+    @classmethod
+    def read(cls, reader, schema=None):
+        size = ShortTag.read(reader).data
+        return StringTag(reader.read(size).decode("utf8"))
+    @classmethod
+    def skip(cls, reader):
+        reader.skip(ShortTag.read(reader).data)
+    def write(self, out):
+        data = self.data.encode("utf8")
+        out.write(ShortTag.fmt.pack(len(data)))
+        out.write(data)
+
+class ListTag(BaseTag):
+    __slots__ = ('tag_id',) # Type of the elements, remembered for empty lists
+    def __init__(self, data, tag_id=0):
+        self.data = data
+        self.tag_id = tag_id
+    def __len__(self):
+        return len(self.data)
+    def __getitem__(self, index):
+        return self.data[index]
+    def __repr__(self):
+        return ",".join([repr(i) for i in self.data])
+    @classmethod
+    def read(cls, reader, schema=None):
+        tag_id = ByteTag.read(reader).data
+        count = IntTag.read(reader).data
+        return ListTag(list(read_tags(reader, tag_id, count, schema)), tag_id)
+    @classmethod
+    def skip(cls, reader):
+        type_id = ByteTag.read(reader).data
+        count = IntTag.read(reader).data
+        tag_cls = get_tag_class(type_id)
+        if hasattr(tag_cls, "fmt"): # Fixed size elements can be skipped at once
+            reader.skip(tag_cls.fmt.size * max(count, 0))
+        else:
+            for i in xrange(count):
+                tag_cls.skip(reader)
+    def write(self, out):
+        tag_id = self.data[0].type_id if self.data else self.tag_id
+        out.write(ByteTag.fmt.pack(tag_id))
+        out.write(IntTag.fmt.pack(len(self.data)))
+        for tag in self.data:
+            tag.write(out)
+
+class CompoundTag(BaseTag):
+    __slots__ = ()
+    def __contains__(self, key):
+        return key in self.data
+    def __getitem__(self, key):
+        return self.data[key]
+    def __repr__(self):
+        return "{" + ", ".join(["%s=%s" % (k, repr(self.data[k])) for k in self.data]) + "}"
+    @classmethod
+    def read(cls, reader, schema=None):
+        data = {}
+        for name, tag in read_named_tags(reader, schema=schema):
+            if not tag.unnamed: # Ignore end tags
+                if name in data:
+                    raise DuplicateNamedTagError(name)
+                data[name] = tag
+        return CompoundTag(data)
+    @classmethod
+    def skip(cls, reader):
+        fmt = type_fmt
+        while True:
+            type_id = fmt.unpack(reader.read(fmt.size))[0]
+            if type_id == 0:
+                break
+            StringTag.skip(reader)
+            get_tag_class(type_id).skip(reader)
+    def write(self, out):
+        for name in self.data:
+            write_named_tag(out, name, self.data[name])
+        out.write("\x00")
+
+tag_types = [
+    EndTag, ByteTag, ShortTag, IntTag, LongTag, FloatTag, DoubleTag,
+    ByteArrayTag, StringTag, ListTag, CompoundTag
+]
+
+for type_id, cls in enumerate(tag_types):
+    cls.type_id = type_id
+
+type_fmt = Struct("b")
+
+def get_tag_class(type_id):
+    if type_id < 0 or type_id >= len(tag_types):
+        raise UnknownTagTypeError(type_id)
+    return tag_types[type_id]
+
+def read_tags(reader, type_id, count, schema=None):
+    cls = get_tag_class(type_id)
+    for i in xrange(count):
+        yield cls.read(reader, schema)
+
+def read_named_tags(reader, check_eof=False, schema=None):
+    """Reads named tags until an end tag (or EOF, if check_eof is set).
+
+    If schema is given, it is a dict of the tag names to read, each mapping to
+    the schema for that tag's own children (None reads everything below it).
+    A "*" key matches any name. Tags that are not in the schema are skipped
+    without being decoded, which requires a reader that supports skip()."""
+    fmt = type_fmt
+    while True:
+        data = reader.read(fmt.size)
+        if check_eof and len(data) == 0: break
+        type_id = fmt.unpack(data)[0]
+        if type_id == 0: # Special case: end tags
+            yield None, EndTag()
+            break
+        else:
+            name = StringTag.read(reader).data
+            cls = get_tag_class(type_id)
+            child_schema = None
+            if schema != None:
+                if name in schema:
+                    child_schema = schema[name]
+                elif "*" in schema:
+                    child_schema = schema["*"]
+                else:
+                    cls.skip(reader)
+                    continue
+            yield name, cls.read(reader, child_schema)
+
+def write_named_tag(out, name, tag):
+    """Writes a named tag to a file-like object."""
+    out.write(type_fmt.pack(tag.type_id))
+    StringTag(name).write(out)
+    tag.write(out)
+
+class FastDecoder(object):
+    """An alternative to read_named_tags() that works on a fully decompressed
+    buffer. Values are unpacked straight out of a memoryview with
+    Struct.unpack_from() and offset arithmetic rather than through a file
+    object, and lists of numbers are unpacked with a single Struct call. It
+    builds the same tag trees as the streaming reader and honours the same
+    schema and lazy options."""
+    type_fmt = Struct(">b")
+    short_fmt = Struct(">h")
+    int_fmt = Struct(">i")
+    list_fmts = {}
+
+    def __init__(self, buf, lazy=False):
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.lazy = lazy
+
+    def list_fmt(self, fmt, count):
+        key = (fmt.format, count)
+        list_fmt = self.list_fmts.get(key)
+        if list_fmt == None:
+            list_fmt = Struct(">%d%s" % (count, fmt.format[1:]))
+            if len(self.list_fmts) < 1024:
+                self.list_fmts[key] = list_fmt
+        return list_fmt
+
+    def read_named_tags(self, pos, schema=None, check_eof=False):
+        """Reads named tags starting at pos until an end tag (or the end of
+        the buffer, if check_eof is set). Returns a list of (name, tag) tuples,
+        including the end tag, and the position after the last tag."""
+        buf = self.buf
+        view = self.view
+        end = len(buf)
+        tags = []
+        while True:
+            if check_eof and pos >= end: break
+            type_id = self.type_fmt.unpack_from(view, pos)[0]
+            pos = pos + 1
+            if type_id == 0: # Special case: end tags
+                tags.append((None, EndTag()))
+                break
+            size = self.short_fmt.unpack_from(view, pos)[0]
+            name = buf[pos + 2:pos + 2 + size].decode("utf8")
+            pos = pos + 2 + max(size, 0)
+            cls = get_tag_class(type_id)
+            child_schema = None
+            if schema != None:
+                if name in schema:
+                    child_schema = schema[name]
+                elif "*" in schema:
+                    child_schema = schema["*"]
+                else:
+                    pos = self.skip(pos, cls)
+                    continue
+            tag, pos = self.read(pos, cls, child_schema)
+            tags.append((name, tag))
+        return tags, pos
+
+    def read(self, pos, cls, schema=None):
+        """Reads the payload of a tag of the given class at pos. Returns the
+        tag and the position after it."""
+        view = self.view
+        if cls is CompoundTag:
+            data = {}
+            tags, pos = self.read_named_tags(pos, schema)
+            for name, tag in tags:
+                if not tag.unnamed: # Ignore end tags
+                    if name in data:
+                        raise DuplicateNamedTagError(name)
+                    data[name] = tag
+            return CompoundTag(data), pos
+        elif cls is ListTag:
+            type_id = self.type_fmt.unpack_from(view, pos)[0]
+            count = self.int_fmt.unpack_from(view, pos + 1)[0]
+            pos = pos + 5
+            tag_cls = get_tag_class(type_id)
+            if count > 0 and hasattr(tag_cls, "fmt"):
+                # Check before building the Struct, whose format grows with count
+                if count * tag_cls.fmt.size > len(self.buf) - pos:
+                    raise FormatParseException(
+                        "List of {0} elements runs past the end of the data".format(count))
+                list_fmt = self.list_fmt(tag_cls.fmt, count)
+                data = map(tag_cls, list_fmt.unpack_from(view, pos))
+                pos = pos + list_fmt.size
+            else:
+                data = []
+                for i in xrange(count):
+                    tag, pos = self.read(pos, tag_cls, schema)
+                    data.append(tag)
+            return ListTag(data, type_id), pos
+        elif cls is ByteArrayTag:
+            size = self.int_fmt.unpack_from(view, pos)[0]
+            if size < 0:
+                raise FormatParseException("Negative byte array size: {0}".format(size))
+            pos = pos + 4
+            end = min(pos + size, len(self.buf))
+            if self.lazy:
+                return LazyByteArrayTag(self.buf, pos, end - pos), end
+            return ByteArrayTag(self.buf[pos:end]), end
+        elif cls is StringTag:
+            size = self.short_fmt.unpack_from(view, pos)[0]
+            if size < 0:
+                raise FormatParseException("Negative string size: {0}".format(size))
+            pos = pos + 2
+            end = min(pos + size, len(self.buf))
+            return StringTag(self.buf[pos:end].decode("utf8")), end
+        else:
+            return cls(cls.fmt.unpack_from(view, pos)[0]), pos + cls.fmt.size
+
+    def skip_size(self, size):
+        if size < 0: # The stream engine's reader refuses these too
+            raise FormatParseException("Negative tag size: {0}".format(size))
+        return size
+
+    def skip(self, pos, cls):
+        """Returns the position after a tag of the given class at pos without
+        decoding it."""
+        view = self.view
+        if cls is CompoundTag:
+            while True:
+                type_id = self.type_fmt.unpack_from(view, pos)[0]
+                pos = pos + 1
+                if type_id == 0:
+                    return pos
+                pos = pos + 2 + max(self.short_fmt.unpack_from(view, pos)[0], 0)
+                pos = self.skip(pos, get_tag_class(type_id))
+        elif cls is ListTag:
+            type_id = self.type_fmt.unpack_from(view, pos)[0]
+            count = self.int_fmt.unpack_from(view, pos + 1)[0]
+            pos = pos + 5
+            tag_cls = get_tag_class(type_id)
+            if hasattr(tag_cls, "fmt"):
+                return pos + tag_cls.fmt.size * max(count, 0)
+            for i in xrange(count):
+                pos = self.skip(pos, tag_cls)
+            return pos
+        elif cls is ByteArrayTag:
+            return pos + 4 + self.skip_size(self.int_fmt.unpack_from(view, pos)[0])
+        elif cls is StringTag:
+            return pos + 2 + self.skip_size(self.short_fmt.unpack_from(view, pos)[0])
+        else:
+            return pos + cls.fmt.size
+
+def loads(buf, lazy=False, schema=None):
+    """Decodes uncompressed NBT into a list of (name, tag) root tags."""
+    tags = FastDecoder(buf, lazy).read_named_tags(0, schema, check_eof=True)[0]
+    return [(name, tag) for name, tag in tags if not tag.unnamed]
+
+def dumps(tags):
+    """Encodes a list of (name, tag) root tags into uncompressed NBT."""
+    out = StringIO()
+    for name, tag in tags:
+        write_named_tag(out, name, tag)
+    return out.getvalue()
+
+def load(path, lazy=False, schema=None):
+    """Reads a gzipped NBT file, such as a chunk file, into a list of (name,
+    tag) root tags."""
+    f = gzip.open(path, "rb")
+    try:
+        return loads(f.read(), lazy, schema)
+    finally:
+        f.close()
+
+def dump(path, tags):
+    """Writes a list of (name, tag) root tags to a gzipped NBT file."""
+    f = gzip.open(path, "wb")
+    try:
+        f.write(dumps(tags))
+    finally:
+        f.close()
@@ -1,308 +1,701 @@
-#!/usr/bin/env python
-#
-# TrillStat
-# Copyright (C) 2010 sk89q <http://www.sk89q.com>
-#
-# This program is free software: you can redistribute it and/or modify it under 
-# the terms of the GNU General Public License as published by the Free
-# Software Foundation: either version 2 of the License, or (at your option) 
-# any later version.
-#
-# This program is distributed in the hope that it will be useful, but WITHOUT
-# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
-# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more 
-# details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-#
-# $Id$
-
-import sys
-import os.path
-from optparse import OptionParser
-import ConfigParser
-import re
-from glob import glob
-import time
-import urllib
-import xml.dom
-from xml.dom import minidom
-try:
-    import ctypes
-    from ctypes import wintypes, windll
-except: pass
-
-class DefaultDict(dict):
-    def __getitem__(self, key):
-        try:
-            return dict.__getitem__(self, key)
-        except KeyError:
-            return 0
-
-class TopDict(dict):
-    def __setitem__(self, key, value):
-        if key in self and self[key] > value: return
-        return dict.__setitem__(self, key, value)
-
-class UsersDict(dict):
-    def __setitem__(self, key, value):
-        key = (key[0], key[1].lower().strip())
-        return dict.__setitem__(self, key, value)
-    
-    def __getitem__(self, key):
-        key = (key[0], key[1].lower().strip())
-        try:
-            return dict.__getitem__(self, key)
-        except KeyError:
-            return key[1]
-
-def get_trillian_users_dir():
-    try:
-        CSIDL_APPDATA = 26
-
-        _SHGetFolderPath = windll.shell32.SHGetFolderPathW
-        _SHGetFolderPath.argtypes = [wintypes.HWND,
-                                    ctypes.c_int,
-                                    wintypes.HANDLE,
-                                    wintypes.DWORD, wintypes.LPCWSTR]
-
-        path_buf = wintypes.create_unicode_buffer(wintypes.MAX_PATH)
-        result = _SHGetFolderPath(0, CSIDL_APPDATA, 0, 0, path_buf)
-        value = os.path.join(path_buf.value.strip(), "Trillian/users")
-        if os.path.isdir(value): return value
-        return None
-    except:
-        return None
-
-def super_url_quote(s):
-    new_s = ""
-    i = 0
-    while i < len(s):
-        o = ord(s[i])
-        if (o >= 48 and o <= 57) or (o >= 65 and o <= 90) or \
-            (o >= 97 and o <= 122):
-            new_s += s[i]
-        else:
-            new_s += "%" + s[i].encode('hex').upper()
-        i = i + 1
-    return new_s
-
-def uniquify(lst):
-    keys = {} 
-    for entry in lst: 
-        keys[entry] = 1 
-    return keys.keys()
-
-def sort_results(lst):
-    lst = [(k, lst[k]) for k in lst]
-    lst.sort(lambda a, b: b[1] - a[1])
-    return lst
-
-def format_time(t):
-    mins, secs = divmod(t, 60)
-    hrs, mins = divmod(mins, 60)
-    days, hrs = divmod(hrs, 25)
-    return "%03sd %02sh %02sm %02ss" % (days, hrs, mins, secs)
-
-def generate(buddies_file, logs_dir, min_time):
-    url_re = re.compile("(?:ht|f)tps?://[^ \"<>]+")
-
-    users = UsersDict()
-    recvd_from = DefaultDict()
-    said_to = DefaultDict()
-    session_time = DefaultDict()
-    top_outgoing = DefaultDict()
-    top_words = DefaultDict()
-    top_urls = DefaultDict()
-
-    dom = minidom.parse(buddies_file)
-
-    for node in dom.getElementsByTagName("buddy"):
-        medium, uri = node.getAttribute("uri").split(":", 1)
-        uri = urllib.unquote(uri).split(':')
-        id = uri[1] if len(uri) > 1 else uri[0]
-        name = id
-        
-        try:
-            name = urllib.unquote(node.childNodes[0].data)
-            
-            if node.parentNode.localName == "metacontact":
-                title = node.parentNode.getElementsByTagName("title")
-                name = urllib.unquote(title[0].childNodes[0].data)
-        except: pass
-        
-        users[(medium, id)] = name
-
-    logs = glob(os.path.join(logs_dir, "*/Query/*.xml"))
-
-    for log in logs:
-        print >>sys.stderr, log
-        
-        nodes = []
-        session_start = None
-        last_time = 0
-        
-        f = open(log, "r")
-        data = f.read()
-        f.close()
-        
-        # Wrap the document in XML tags to make it valid
-        dom = minidom.parseString("<log>%s</log>" % data)
-        
-        # Build a list of nodes which we will sort
-        for node in dom.documentElement.childNodes:
-            if node.nodeType == xml.dom.Node.ELEMENT_NODE:
-                try:
-                    time = int(node.getAttribute('time'))
-                except Exception, e:
-                    time = 0
-                if min_time != None and time < min_time: continue
-                nodes.append((time, node))
-        
-        nodes.sort(lambda a, b: a[0] - b[0])
-        nodes = [n[1] for n in nodes]
-        
-        for node in nodes:
-            medium = node.getAttribute("medium")
-            sender = users[(medium, urllib.unquote(node.getAttribute("from")))]
-            recipient = users[(medium, urllib.unquote(node.getAttribute("to")))]
-            type = node.getAttribute("type")
-            try:
-                time = int(node.getAttribute('time'))
-            except:
-                time = 0
-            
-            if node.localName == "session": # Track session time
-                if type == "start":
-                    if session_start != None:
-                        print >>sys.stderr, "warning: Found session start without a stop of a previous session"
-                        
-                        if last_time > 0:
-                            session_time[recipient] = session_time[recipient] + (last_time - session_start)
-                    if time > 0:
-                        session_start = time
-                    else:
-                        print >>sys.stderr, "warning: Timestamp of 0 or less"
-                elif type == "stop":
-                    if session_start == None:
-                        print >>sys.stderr, "warning: Found session stop without a start"
-                    elif time < 0:
-                        print >>sys.stderr, "warning: Timestamp of 0 or less"
-                    else:
-                        session_time[recipient] = session_time[recipient] + (time - session_start)
-                    session_start = None
-            elif node.localName == "message": # Track messages
-                text = urllib.unquote(node.getAttribute("text"))
-                text_norm = text.lower().strip()
-                
-                urls = uniquify(url_re.findall(text))
-                for url in urls: top_urls[url] = top_urls[url] + 1
-                
-                if type == "incoming_privateMessage":
-                    recvd_from[sender] = recvd_from[sender] + 1
-                elif type == "outgoing_privateMessage":
-                    said_to[recipient] = said_to[recipient] + 1
-                    top_outgoing[text_norm] = top_outgoing[text_norm] + 1
-                    words = filter(lambda t: t != "", text_norm.split(" "))
-                    for w in words: top_words[w] = top_words[w] + 1
-            
-            last_time = time
-        
-        if session_start != None:
-            print >>sys.stderr, "warning: Session is currently active"
-            session_time[recipient] = session_time[recipient] + (last_time - session_start)
-
-    print >>sys.stderr, "Statistics collection completed!"
-    print >>sys.stderr, ""
-
-    print "=== # of Messages Received ==="
-    for row in sort_results(recvd_from)[:20]:
-        print "%5s %s"  % (row[1], row[0].encode('utf-8'))
-
-    print
-    print "=== # of Messages Sent ==="
-    for row in sort_results(said_to)[:20]:
-        print "%5s %s"  % (row[1], row[0].encode('utf-8'))
-
-    print
-    print "=== Longest Times You Kept the Window Open ==="
-    for row in sort_results(session_time)[:40]:
-        print "%12s %s"  % (format_time(row[1]), row[0].encode('utf-8'))
-
-    print
-    print "=== Top Lines You Said ==="
-    for row in sort_results(top_outgoing)[:30]:
-        print "%5s %s"  % (row[1], row[0].encode('utf-8'))
-
-    print
-    print "=== Top Words You Said ==="
-    for row in sort_results(top_words)[:30]:
-        print "%5s %s"  % (row[1], row[0].encode('utf-8'))
-
-    print
-    print "=== Top URLs Sent/Received ==="
-    for row in sort_results(top_urls)[:30]:
-        print "%5s %s"  % (row[1], row[0].encode('utf-8'))
-
-def main():
-    print >>sys.stderr, "TrillStat"
-    print >>sys.stderr, "Copyright (C) 2010 sk89q <http://www.sk89q.com>"
-    print >>sys.stderr, ""
-    
-    parser = OptionParser("%prog [options]")
-    parser.add_option("-d", "--users-dir", dest="dir",
-                      help="AppData users directory", action="store",
-                      default=None)
-    parser.add_option("-u", "--user", dest="user", help="User", action="store",
-                      default=None)
-    parser.add_option("--max-days", dest="days", help="Max. age in days", action="store",
-                      type="int", default=None)
-    (options, args) = parser.parse_args()
-    
-    dir = get_trillian_users_dir()
-    user = super_url_quote(options.user) if options.user else None
-    
-    if options.dir:
-        if not os.path.isdir(options.dir):
-            parser.error("The specified users directory does not exist.")
-        else:
-            dir = options.dir
-    else:
-        if not dir or not os.path.isdir(dir):
-            parser.error("Your Trillian users directory could not be detected.")
-    
-    if user:
-        if not os.path.isfile(os.path.join(dir, user, "talk.ini")) or \
-            not os.path.isfile(os.path.join(dir, user, "Buddies.xml")):
-            parser.error("The specified user does not exist.")
-    else:
-        users = []
-        for o in os.listdir(dir):
-            if o != "global" and os.path.isdir(os.path.join(dir, o)):
-                users.append(o)
-        if len(users) >= 1:
-            user = users[0]
-        else:
-            parser.error("No user was found.")
-    
-    print "Getting stats for user %s" % urllib.unquote(user)
-    
-    base_dir = os.path.join(dir, user)
-    buddies_file = os.path.join(base_dir, "Buddies.xml")
-    talk_file = os.path.join(base_dir, "talk.ini")
-    
-    try:
-        talk = ConfigParser.RawConfigParser()
-        talk.read(talk_file)
-        log_dir = talk.get("Logging", "Directory")
-    except:
-        print >>sys.stderr, "error: Could not read log directory from talk.ini"
-        sys.exit(2)
-    
-    min_time = time.time() - options.days * 60 * 60 * 24 if options.days else None
-    
-    generate(buddies_file, log_dir, min_time=min_time)
-
-if __name__ == "__main__":
+#!/usr/bin/env python
+#
+# TrillStat
+# Copyright (C) 2010 sk89q <http://www.sk89q.com>
+#
+# This program is free software: you can redistribute it and/or modify it under 
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation: either version 2 of the License, or (at your option) 
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more 
+# details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# $Id$
+
+import sys
+import os.path
+from optparse import OptionParser
+import ConfigParser
+import re
+from glob import glob
+import time
+import urllib
+import heapq
+import functools
+import itertools
+import multiprocessing
+import hashlib
+import sqlite3
+from xml.dom import minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+try:
+    import ctypes
+    from ctypes import wintypes, windll
+except: pass
+
+class DefaultDict(dict):
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return 0
+    
+    def add(self, key, n=1):
+        self[key] = self[key] + n
+
+class SpaceSaving(object):
+    """Approximate counts of the most frequent keys, kept in a fixed number of
+    counters with the Space-Saving algorithm (Metwally et al., 2005). Once all
+    counters are in use, a new key takes over the counter with the lowest
+    count and carries on from there. A count is therefore never too low, and
+    it is too high by at most the lowest count, which is never more than
+    total / size. Any key counted more than total / size times is sure to
+    have a counter.
+    
+    Summaries of separately read logs are added together with merge(). The
+    errors of both then carry over, and a count can be too low as well,
+    but never off by more than max_error()."""
+    def __init__(self, size):
+        self.size = size
+        self.total = 0
+        self.counts = {}
+        self.heap = [] # (count, key), with stale entries left in
+        self.merged_error = 0
+    
+    def __getitem__(self, key):
+        return self.counts.get(key, 0)
+    
+    def add(self, key, n=1):
+        self.total = self.total + n
+        count = self.counts.get(key)
+        if count == None:
+            count = self.pop_min() if len(self.counts) >= self.size else 0
+        count = count + n
+        self.counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+        if len(self.heap) > self.size * 2 + 64: # Drop the stale entries
+            self.heap = [(c, k) for k, c in self.counts.iteritems()]
+            heapq.heapify(self.heap)
+    
+    def pop_min(self):
+        """Removes the key with the lowest count and returns its count."""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                return count
+    
+    def merge(self, other):
+        """Adds the counts of another summary to this one."""
+        for key, count in other.iteritems():
+            self.add(key, count)
+        self.merged_error = self.merged_error + other.max_error()
+    
+    def iteritems(self):
+        return self.counts.iteritems()
+    
+    def max_error(self):
+        """Returns how far off any count can be."""
+        if len(self.counts) < self.size:
+            return self.merged_error
+        return min(self.counts.itervalues()) + self.merged_error
+
+class TopDict(dict):
+    def __setitem__(self, key, value):
+        if key in self and self[key] > value: return
+        return dict.__setitem__(self, key, value)
+
+class UsersDict(dict):
+    def __setitem__(self, key, value):
+        key = (key[0], key[1].lower().strip())
+        return dict.__setitem__(self, key, value)
+    
+    def __getitem__(self, key):
+        key = (key[0], key[1].lower().strip())
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return key[1]
+
+def get_trillian_users_dir():
+    try:
+        CSIDL_APPDATA = 26
+
+        _SHGetFolderPath = windll.shell32.SHGetFolderPathW
+        _SHGetFolderPath.argtypes = [wintypes.HWND,
+                                    ctypes.c_int,
+                                    wintypes.HANDLE,
+                                    wintypes.DWORD, wintypes.LPCWSTR]
+
+        path_buf = wintypes.create_unicode_buffer(wintypes.MAX_PATH)
+        result = _SHGetFolderPath(0, CSIDL_APPDATA, 0, 0, path_buf)
+        value = os.path.join(path_buf.value.strip(), "Trillian/users")
+        if os.path.isdir(value): return value
+        return None
+    except:
+        return None
+
+def super_url_quote(s):
+    new_s = ""
+    i = 0
+    while i < len(s):
+        o = ord(s[i])
+        if (o >= 48 and o <= 57) or (o >= 65 and o <= 90) or \
+            (o >= 97 and o <= 122):
+            new_s += s[i]
+        else:
+            new_s += "%" + s[i].encode('hex').upper()
+        i = i + 1
+    return new_s
+
+def uniquify(lst):
+    keys = {} 
+    for entry in lst: 
+        keys[entry] = 1 
+    return keys.keys()
+
+def top_results(counts, n):
+    """Returns the n (key, count) pairs with the highest counts, highest
+    first. This keeps a heap of n pairs rather than sorting every key."""
+    return heapq.nlargest(n, counts.iteritems(), key=lambda row: row[1])
+
+def format_time(t):
+    mins, secs = divmod(t, 60)
+    hrs, mins = divmod(mins, 60)
+    days, hrs = divmod(hrs, 25)
+    return "%03sd %02sh %02sm %02ss" % (days, hrs, mins, secs)
+
+class LogStream(object):
+    """Wraps a log file in <log> tags as it is read, because a log is a
+    list of elements without a root element. If size is given, only that
+    many bytes are read from the file."""
+    def __init__(self, f, size=None):
+        self.f = f
+        self.remaining = size
+        self.pending = "<log>"
+        self.done = False
+    
+    def read(self, size=-1):
+        if self.pending:
+            data, self.pending = self.pending, ""
+            return data
+        if self.done:
+            return ""
+        if self.remaining != None:
+            size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        if self.remaining != None:
+            self.remaining = self.remaining - len(data)
+        if not data:
+            self.done = True
+            return "</log>"
+        return data
+
+# Log entries that are out of order by up to this many entries are sorted
+# into place
+REORDER_WINDOW = 1000
+
+def read_log(path, min_time=None, start=0, end=None):
+    """Yields the (tag, attributes) of the entries of a log in order of
+    time. Entries are parsed one at a time and thrown away once read, so
+    memory use does not grow with the size of the log. Trillian appends to
+    logs as messages come in, so the entries are nearly in order already.
+    
+    Only the bytes from start up to end are read if they are given."""
+    f = open(path, "rb")
+    try:
+        f.seek(start)
+        stream = LogStream(f, end - start if end != None else None)
+        heap = []
+        i = 0
+        depth = 0
+        root = None
+        for event, elem in ElementTree.iterparse(stream, ("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth = depth + 1
+                continue
+            depth = depth - 1
+            if depth != 1: continue
+            attrs = dict([(k, unicode(v)) for k, v in elem.attrib.items()])
+            tag = elem.tag
+            root.clear()
+            try:
+                time = int(attrs.get('time'))
+            except Exception, e:
+                time = 0
+            if min_time != None and time < min_time: continue
+            heapq.heappush(heap, (time, i, tag, attrs))
+            i = i + 1
+            if len(heap) > REORDER_WINDOW:
+                yield heapq.heappop(heap)[2:]
+        while heap:
+            yield heapq.heappop(heap)[2:]
+    finally:
+        f.close()
+
+url_re = re.compile("(?:ht|f)tps?://[^ \"<>]+")
+
+class LogStats(object):
+    """The statistics of one or more logs. The statistics of logs that were
+    read separately add up with add()."""
+    fields = ['recvd_from', 'said_to', 'session_time', 'top_outgoing',
+              'top_words', 'top_urls']
+    # Fields that can have any number of keys, and so can be approximate
+    open_fields = ['top_outgoing', 'top_words', 'top_urls']
+    
+    def __init__(self, approximate=None):
+        for name in self.fields:
+            if approximate and name in self.open_fields:
+                setattr(self, name, SpaceSaving(approximate))
+            else:
+                setattr(self, name, DefaultDict())
+    
+    def add(self, other):
+        for name in self.fields:
+            counts = getattr(self, name)
+            if isinstance(counts, SpaceSaving):
+                counts.merge(getattr(other, name))
+                continue
+            for key, value in getattr(other, name).iteritems():
+                counts[key] = counts[key] + value
+    
+    def at(self, time):
+        """Returns the LogStats that counts what happens at time."""
+        return self
+
+DAY = 60 * 60 * 24
+
+class DailyStats(object):
+    """Statistics kept apart for each day (in UTC)."""
+    def __init__(self):
+        self.days = {}
+    
+    def at(self, time):
+        day = time // DAY
+        stats = self.days.get(day)
+        if stats == None:
+            stats = self.days[day] = LogStats()
+        return stats
+
+def read_log_stats(log, users, min_time=None, stats=None, state=None,
+                   start=0, end=None, approximate=None):
+    """Reads a log and adds its statistics to stats, or to a new LogStats if
+    stats is not given (approximate is then passed on to it). Returns the
+    LogStats.
+    
+    If state is given, reading carries on from the session state of an
+    earlier read that stopped at start. A session that is still open at the
+    end is then left in state instead of being counted."""
+    print >>sys.stderr, log
+    
+    if stats == None:
+        stats = LogStats(approximate)
+    
+    if state != None:
+        session_start = state['session_start']
+        last_time = state['last_time']
+        recipient = state['recipient']
+    else:
+        session_start = None
+        last_time = 0
+    
+    for tag, attrs in read_log(log, min_time, start, end):
+        medium = attrs.get("medium", u"")
+        sender = users[(medium, urllib.unquote(attrs.get("from", u"")))]
+        recipient = users[(medium, urllib.unquote(attrs.get("to", u"")))]
+        type = attrs.get("type", u"")
+        try:
+            time = int(attrs.get('time'))
+        except:
+            time = 0
+        counts = stats.at(time)
+        
+        if tag == "session": # Track session time
+            if type == "start":
+                if session_start != None:
+                    print >>sys.stderr, "warning: Found session start without a stop of a previous session"
+                    
+                    if last_time > 0:
+                        counts.session_time[recipient] = counts.session_time[recipient] + (last_time - session_start)
+                if time > 0:
+                    session_start = time
+                else:
+                    print >>sys.stderr, "warning: Timestamp of 0 or less"
+            elif type == "stop":
+                if session_start == None:
+                    print >>sys.stderr, "warning: Found session stop without a start"
+                elif time < 0:
+                    print >>sys.stderr, "warning: Timestamp of 0 or less"
+                else:
+                    counts.session_time[recipient] = counts.session_time[recipient] + (time - session_start)
+                session_start = None
+        elif tag == "message": # Track messages
+            text = urllib.unquote(attrs.get("text", u""))
+            text_norm = text.lower().strip()
+            
+            urls = uniquify(url_re.findall(text))
+            for url in urls: counts.top_urls.add(url)
+            
+            if type == "incoming_privateMessage":
+                counts.recvd_from[sender] = counts.recvd_from[sender] + 1
+            elif type == "outgoing_privateMessage":
+                counts.said_to[recipient] = counts.said_to[recipient] + 1
+                counts.top_outgoing.add(text_norm)
+                words = filter(lambda t: t != "", text_norm.split(" "))
+                for w in words: counts.top_words.add(w)
+        
+        last_time = time
+    
+    if state != None:
+        state.update(session_start=session_start, last_time=last_time,
+                     recipient=recipient)
+    elif session_start != None:
+        print >>sys.stderr, "warning: Session is currently active"
+        stats.session_time[recipient] = stats.session_time[recipient] + (last_time - session_start)
+    
+    return stats
+
+def read_log_job(job, users):
+    """Reads what a StatsDB.plan() job covers into a DailyStats. Returns the
+    DailyStats and the session state at the end."""
+    log, start, end, state, head = job
+    stats = DailyStats()
+    state = dict(state)
+    read_log_stats(log, users, None, stats, state, start, end)
+    return stats, state
+
+def imap_logs(func, items, jobs=1, **kwargs):
+    """Yields func(item, **kwargs) for each item, in order. With jobs above 1
+    the items are handled by a pool of that many processes."""
+    func = functools.partial(func, **kwargs)
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+def find_log_end(f, start, size):
+    """Returns the offset just past the last complete entry of a log between
+    start and size, so that an entry that is still being written is left for
+    the next run. Entries end with '>', which never shows up inside one as
+    the text of a message is URL-encoded."""
+    pos = size
+    while pos > start:
+        block_start = max(start, pos - 65536)
+        f.seek(block_start)
+        i = f.read(pos - block_start).rfind(">")
+        if i != -1:
+            return block_start + i + 1
+        pos = block_start
+    return start
+
+class StatsDB(object):
+    """Statistics of the logs kept in a SQLite database between runs. Trillian
+    only appends to logs, so a run only reads what was appended to each log
+    since the last one. Counts are kept for each log and day, so that
+    --max-days is answered from the database. A log that shrank or whose
+    first bytes changed is read again from the start."""
+    version = 1
+    head_size = 1024
+    
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str # Log paths are not necessarily Unicode
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(key TEXT PRIMARY KEY, value TEXT)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row == None or row[0] != str(self.version):
+            self.conn.execute("DROP TABLE IF EXISTS logs")
+            self.conn.execute("DROP TABLE IF EXISTS counts")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                              (str(self.version),))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS logs "
+                          "(id INTEGER PRIMARY KEY, path TEXT UNIQUE, offset INTEGER, "
+                          "head TEXT, session_start INTEGER, last_time INTEGER, "
+                          "recipient TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counts "
+                          "(log INTEGER, stat TEXT, day INTEGER, key TEXT, count INTEGER, "
+                          "PRIMARY KEY (log, stat, day, key))")
+        self.conn.commit()
+    
+    def plan(self, log):
+        """Returns a (log, start, end, state, head) job for the part of a log
+        that has not been read yet, or None if there is nothing new."""
+        row = self.conn.execute("SELECT offset, head, session_start, last_time, recipient "
+                                "FROM logs WHERE path = ?", (log,)).fetchone()
+        state = {'session_start': None, 'last_time': 0, 'recipient': None}
+        start = 0
+        f = open(log, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if row != None and row[0] <= size and \
+                hashlib.sha1(f.read(min(row[0], self.head_size))).hexdigest() == row[1]:
+                start = row[0]
+                state = {'session_start': row[2], 'last_time': row[3],
+                         'recipient': row[4]}
+            end = find_log_end(f, start, size)
+            f.seek(0)
+            head = hashlib.sha1(f.read(min(end, self.head_size))).hexdigest()
+        finally:
+            f.close()
+        if end == start and (start > 0 or row == None):
+            return None
+        return log, start, end, state, head
+    
+    def add(self, job, stats, state):
+        """Stores the DailyStats and session state that a job was read into."""
+        log, start, end, old_state, head = job
+        if start == 0: # Read from the start, so anything stored is stale
+            self.conn.execute("DELETE FROM counts WHERE log IN "
+                              "(SELECT id FROM logs WHERE path = ?)", (log,))
+        self.conn.execute("INSERT OR IGNORE INTO logs (path) VALUES (?)", (log,))
+        self.conn.execute("UPDATE logs SET offset = ?, head = ?, session_start = ?, "
+                          "last_time = ?, recipient = ? WHERE path = ?",
+                          (end, head, state['session_start'], state['last_time'],
+                           state['recipient'], log))
+        id = self.conn.execute("SELECT id FROM logs WHERE path = ?", (log,)).fetchone()[0]
+        rows = []
+        for day, day_stats in stats.days.iteritems():
+            for name in LogStats.fields:
+                for key, count in getattr(day_stats, name).iteritems():
+                    rows.append((count, id, name, day, key))
+        if start > 0:
+            self.conn.executemany("INSERT OR IGNORE INTO counts VALUES (?, ?, ?, ?, 0)",
+                                  [row[1:] for row in rows])
+            self.conn.executemany("UPDATE counts SET count = count + ? WHERE log = ? AND "
+                                  "stat = ? AND day = ? AND key = ?", rows)
+        else:
+            self.conn.executemany("INSERT INTO counts VALUES (?, ?, ?, ?, ?)",
+                                  [row[1:] + row[:1] for row in rows])
+    
+    def prune(self, logs):
+        """Drops the logs that are not in logs."""
+        logs = set(logs)
+        for id, path in self.conn.execute("SELECT id, path FROM logs").fetchall():
+            if path not in logs:
+                self.conn.execute("DELETE FROM counts WHERE log = ?", (id,))
+                self.conn.execute("DELETE FROM logs WHERE id = ?", (id,))
+    
+    def stats(self, min_time=None):
+        """Adds up the counts of every log into a LogStats. If min_time is
+        given, only the days from the one min_time falls on are counted."""
+        stats = LogStats()
+        min_day = int(min_time) // DAY if min_time != None else None
+        for name in LogStats.fields:
+            counts = getattr(stats, name)
+            if min_day != None:
+                rows = self.conn.execute("SELECT key, SUM(count) FROM counts WHERE stat = ? "
+                                         "AND day >= ? GROUP BY key", (name, min_day))
+            else:
+                rows = self.conn.execute("SELECT key, SUM(count) FROM counts WHERE stat = ? "
+                                         "GROUP BY key", (name,))
+            for key, count in rows:
+                counts[key.decode("utf-8")] = count
+        # Sessions that are still open count up to their last entry, as they
+        # do when the logs are read in full
+        for session_start, last_time, recipient in self.conn.execute(
+            "SELECT session_start, last_time, recipient FROM logs "
+            "WHERE session_start IS NOT NULL"):
+            if min_day == None or last_time // DAY >= min_day:
+                recipient = recipient.decode("utf-8")
+                stats.session_time[recipient] = stats.session_time[recipient] + \
+                    (last_time - session_start)
+        return stats
+    
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# Sections of the report as (name, title, LogStats field, default number of
+# rows, row format)
+report_sections = [
+    ('received', "# of Messages Received", 'recvd_from', 20, "%5s %s"),
+    ('sent', "# of Messages Sent", 'said_to', 20, "%5s %s"),
+    ('sessions', "Longest Times You Kept the Window Open", 'session_time', 40, "%12s %s"),
+    ('lines', "Top Lines You Said", 'top_outgoing', 30, "%5s %s"),
+    ('words', "Top Words You Said", 'top_words', 30, "%5s %s"),
+    ('urls', "Top URLs Sent/Received", 'top_urls', 30, "%5s %s"),
+]
+
+def print_report(stats, top={}):
+    """Prints the top rows of each section. top maps section names to the
+    number of rows to print, if not the default."""
+    for i, (name, title, field, default, format) in enumerate(report_sections):
+        if i > 0:
+            print
+        print "=== %s ===" % title
+        for key, count in top_results(getattr(stats, field), top.get(name, default)):
+            if field == 'session_time':
+                count = format_time(count)
+            print format % (count, key.encode('utf-8'))
+
+def generate(buddies_file, logs_dir, min_time, jobs=1, db_file=None, top={},
+             approximate=None):
+    users = UsersDict()
+    stats = LogStats(approximate)
+
+    dom = minidom.parse(buddies_file)
+
+    for node in dom.getElementsByTagName("buddy"):
+        medium, uri = node.getAttribute("uri").split(":", 1)
+        uri = urllib.unquote(uri).split(':')
+        id = uri[1] if len(uri) > 1 else uri[0]
+        name = id
+        
+        try:
+            name = urllib.unquote(node.childNodes[0].data)
+            
+            if node.parentNode.localName == "metacontact":
+                title = node.parentNode.getElementsByTagName("title")
+                name = urllib.unquote(title[0].childNodes[0].data)
+        except: pass
+        
+        users[(medium, id)] = name
+
+    logs = glob(os.path.join(logs_dir, "*/Query/*.xml"))
+
+    if db_file:
+        db = StatsDB(db_file)
+        try:
+            db.prune(logs)
+            work = filter(None, [db.plan(log) for log in logs])
+            for job, result in itertools.izip(work, imap_logs(read_log_job, work, jobs,
+                                                              users=users)):
+                db.add(job, *result)
+            stats = db.stats(min_time)
+        finally:
+            db.close()
+    elif jobs > 1:
+        # Logs are independent of each other, so they are read by a pool of
+        # processes and their statistics are added up as they come in
+        for log_stats in imap_logs(read_log_stats, logs, jobs, users=users,
+                                   min_time=min_time, approximate=approximate):
+            stats.add(log_stats)
+    else:
+        for log in logs:
+            read_log_stats(log, users, min_time, stats)
+
+    print >>sys.stderr, "Statistics collection completed!"
+    for name, title, field, default, format in report_sections:
+        counts = getattr(stats, field)
+        if isinstance(counts, SpaceSaving):
+            print >>sys.stderr, "note: '%s' counts are approximate and may be off " \
+                                "by up to %d" % (title, counts.max_error())
+    print >>sys.stderr, ""
+
+    print_report(stats, top)
+
+def main():
+    print >>sys.stderr, "TrillStat"
+    print >>sys.stderr, "Copyright (C) 2010 sk89q <http://www.sk89q.com>"
+    print >>sys.stderr, ""
+    
+    parser = OptionParser("%prog [options]")
+    parser.add_option("-d", "--users-dir", dest="dir",
+                      help="AppData users directory", action="store",
+                      default=None)
+    parser.add_option("-u", "--user", dest="user", help="User", action="store",
+                      default=None)
+    parser.add_option("--max-days", dest="days", help="Max. age in days", action="store",
+                      type="int", default=None)
+    parser.add_option("-j", "--jobs", dest="jobs", help="Number of logs to read at once",
+                      action="store", type="int", default=1)
+    parser.add_option("--top", dest="top", help="Number of rows to show, either for "
+                      "every section (N) or for one (SECTION=N, where SECTION is one "
+                      "of %s); can be repeated" % ", ".join([s[0] for s in report_sections]),
+                      action="append", default=[], metavar="[SECTION=]N")
+    parser.add_option("--approximate", dest="approximate", help="Count lines, words "
+                      "and URLs approximately, keeping only this many counters for each",
+                      action="store", type="int", default=None, metavar="COUNTERS")
+    parser.add_option("--db", dest="db", help="Statistics database, so that later runs "
+                      "only read new log entries", action="store", default=None)
+    (options, args) = parser.parse_args()
+    
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    
+    if options.approximate != None:
+        if options.approximate < 1:
+            parser.error("--approximate needs at least 1 counter.")
+        if options.db:
+            parser.error("--approximate cannot be used with --db.")
+    
+    top = {}
+    for value in options.top:
+        names, n = value.rsplit("=", 1) if "=" in value else (None, value)
+        try:
+            n = int(n)
+        except ValueError:
+            parser.error("--top expects a number of rows.")
+        if names == None:
+            names = [s[0] for s in report_sections]
+        elif names in [s[0] for s in report_sections]:
+            names = [names]
+        else:
+            parser.error("Unknown report section '%s'." % names)
+        for name in names:
+            top[name] = n
+    
+    dir = get_trillian_users_dir()
+    user = super_url_quote(options.user) if options.user else None
+    
+    if options.dir:
+        if not os.path.isdir(options.dir):
+            parser.error("The specified users directory does not exist.")
+        else:
+            dir = options.dir
+    else:
+        if not dir or not os.path.isdir(dir):
+            parser.error("Your Trillian users directory could not be detected.")
+    
+    if user:
+        if not os.path.isfile(os.path.join(dir, user, "talk.ini")) or \
+            not os.path.isfile(os.path.join(dir, user, "Buddies.xml")):
+            parser.error("The specified user does not exist.")
+    else:
+        users = []
+        for o in os.listdir(dir):
+            if o != "global" and os.path.isdir(os.path.join(dir, o)):
+                users.append(o)
+        if len(users) >= 1:
+            user = users[0]
+        else:
+            parser.error("No user was found.")
+    
+    print "Getting stats for user %s" % urllib.unquote(user)
+    
+    base_dir = os.path.join(dir, user)
+    buddies_file = os.path.join(base_dir, "Buddies.xml")
+    talk_file = os.path.join(base_dir, "talk.ini")
+    
+    try:
+        talk = ConfigParser.RawConfigParser()
+        talk.read(talk_file)
+        log_dir = talk.get("Logging", "Directory")
+    except:
+        print >>sys.stderr, "error: Could not read log directory from talk.ini"
+        sys.exit(2)
+    
+    min_time = time.time() - options.days * 60 * 60 * 24 if options.days else None
+    
+    generate(buddies_file, log_dir, min_time=min_time, jobs=options.jobs,
+             db_file=options.db, top=top, approximate=options.approximate)
+
+if __name__ == "__main__":
     main()
\ No newline at end of file